@@ -1,8 +1,20 @@
 # ai_manager.py
 import os
-from openai import OpenAI
+import re
+import json
+import random
+import asyncio
+import hashlib
+import openai
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import config
+import database_manager
+
+try:
+    import tiktoken  # Optional: exact token counts. Falls back to ~4 characters per token.
+except ImportError:
+    tiktoken = None
 
 # --- Load environment variables ---
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -14,12 +26,85 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY not found. Please set it in your .env file.")
 
-# Initialize the OpenAI Client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Errors worth another attempt; anything else (bad request, auth) fails right away
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError,
+    openai.RateLimitError, openai.InternalServerError,
+)
+
+# --- Token-budgeted prompt assembly ---
+# Scraped attachment placeholders ("📷 Image (WhatsApp Image 3f9a….jpg)") carry file
+# names the model can't use; they are collapsed to short tags like "[2 images]".
+ATTACHMENT_PLACEHOLDERS = [
+    (re.compile(r"^📷 Image\b"), "image"),
+    (re.compile(r"^🎥 Video\b"), "video"),
+    (re.compile(r"^📎 Document\b"), "document"),
+    (re.compile(r"^🎤 Voice Message"), "voice message"),
+    (re.compile(r"^📍 Location\b"), "location"),
+]
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators per chat message
+_encoding = None
+
+def _get_encoding():
+    """The model's tokenizer, loaded on first use; None if tiktoken is missing or can't load it."""
+    global _encoding
+    if _encoding is None and tiktoken:
+        try:
+            _encoding = tiktoken.encoding_for_model(config.AI_MODEL)
+        except Exception:
+            try: _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception: _encoding = False
+    return _encoding or None
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    return len(encoding.encode(text)) if encoding else (len(text) + 3) // 4
+
+def _truncate(text, max_tokens):
+    """Keeps the start of an oversized message, marking the cut."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    head = encoding.decode(encoding.encode(text)[:max_tokens]) if encoding else text[:max_tokens * 4]
+    return head.rstrip() + " …[truncated]"
+
+def _attachment_kind(content):
+    for pattern, kind in ATTACHMENT_PLACEHOLDERS:
+        if pattern.match(content): return kind
+    return None
+
+def _attachment_tag(kinds):
+    counts = {}
+    for kind in kinds:
+        counts[kind] = counts.get(kind, 0) + 1
+    return "[" + ", ".join(kind if n == 1 else f"{n} {kind}s" for kind, n in counts.items()) + "]"
+
+def _compact_turns(history):
+    """
+    Maps DB history to (role, content) turns: drops unsupported/empty messages,
+    merges runs of attachments from the same side into one tag, truncates long texts.
+    """
+    turns, kinds = [], []
+    for msg in history:
+        # Map your DB roles to OpenAI roles
+        role = "assistant" if msg["role"] == "me" else "user"
+        content = (msg.get("content") or "").strip()
+        if not content or content == "Unsupported or Empty Message": continue
+        kind = _attachment_kind(content)
+        if kind and turns and kinds[-1] and turns[-1][0] == role:
+            kinds[-1].append(kind)
+            turns[-1] = (role, _attachment_tag(kinds[-1]))
+            continue
+        turns.append((role, _attachment_tag([kind]) if kind else _truncate(content, config.AI_MAX_MESSAGE_TOKENS)))
+        kinds.append([kind] if kind else None)
+    return turns
 
-def generate_reply(history, your_name):
+def _build_messages(history):
     """
-    Generates a reply using OpenAI GPT based on the conversation history.
+    Converts DB history to OpenAI chat messages, or returns None when there is
+    nothing worth answering (saves money/quota). The system prompt always comes
+    first and unchanged, so the provider can cache that prefix; then come the newest
+    turns that fit in config.AI_PROMPT_TOKEN_BUDGET (the latest one always does).
     """
     if not history:
         print("   ⚠️ AI Warning: History is empty.")
@@ -33,28 +118,144 @@ def generate_reply(history, your_name):
 
     # --- Convert History to OpenAI Format ---
     # OpenAI roles: "system", "user", "assistant"
-    messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
-    
-    for msg in history:
-        # Map your DB roles to OpenAI roles
-        role = "assistant" if msg["role"] == "me" else "user"
-        messages.append({"role": role, "content": msg["content"]})
+    kept, used = [], 0
+    for role, content in reversed(_compact_turns(history)):
+        cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if kept and used + cost > config.AI_PROMPT_TOKEN_BUDGET: break
+        kept.append({"role": role, "content": content})
+        used += cost
+    return [{"role": "system", "content": config.SYSTEM_PROMPT}] + kept[::-1]
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+_FAST_PATH_RULES = [(rule, [re.compile(p) for p in rule["patterns"]]) for rule in config.FAST_PATH_RULES]
+
+def fast_path_rule(history):
+    """
+    The first FAST_PATH_RULES rule matching the user's latest messages, provided
+    every one of them is trivial (matches some rule). None means the model is needed.
+    """
+    if not config.FAST_PATH_ENABLED:
+        return None
+    latest = []
+    for msg in reversed(history):
+        if msg["role"] == "me": break
+        latest.append(_normalize(re.sub(r"[^\w\s]", " ", msg["content"])))
+    matched = [rule for rule, patterns in _FAST_PATH_RULES if any(p.fullmatch(text) for p in patterns for text in latest)]
+    trivial = all(any(p.fullmatch(text) for _, patterns in _FAST_PATH_RULES for p in patterns) for text in latest)
+    return matched[0] if latest and trivial else None
+
+
+class ReplyCache:
+    """
+    LRU/TTL cache of model replies, persisted in SQLite (the ReplyCache table).
+    Keys hash the model and the normalized prompt, so whitespace or case changes
+    in the history still hit while any change of meaning or system prompt misses.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def key(messages):
+        normalized = [config.AI_MODEL] + [[m["role"], _normalize(m["content"])] for m in messages]
+        return hashlib.blake2b(json.dumps(normalized).encode("utf-8"), digest_size=20).hexdigest()
+
+    def get(self, messages):
+        return database_manager.get_cached_reply(self.key(messages), self.ttl_seconds)
+
+    def put(self, messages, reply):
+        database_manager.save_cached_reply(self.key(messages), reply, self.max_entries, self.ttl_seconds)
 
+
+reply_cache = ReplyCache(config.REPLY_CACHE_MAX_ENTRIES, config.REPLY_CACHE_TTL_SECONDS)
+
+def _answer_locally(history, messages):
+    """(True, reply) when the fast path or the cache answers without the model; reply may be None."""
+    rule = fast_path_rule(history)
+    if rule:
+        print(f"   ⚡ Fast path ({rule['intent']}): {'templated reply' if rule['reply'] else 'no reply needed'}.")
+        return True, rule["reply"]
+    cached = reply_cache.get(messages)
+    if cached:
+        print(f"   💾 Reusing cached reply: '{cached[:50]}...'")
+        return True, cached
+    return False, None
+
+def generate_replies(histories, your_name):
+    """
+    Generates replies for many conversations at once: {key: history} -> {key: reply}.
+    Trivial messages and repeated prompts are answered by the fast path and the
+    reply cache; the rest go to the model with up to config.AI_MAX_CONCURRENCY
+    requests in flight, so a backlog costs about one round trip per batch instead
+    of one per conversation. Conversations with nothing to answer are left out, and
+    so are those whose model call failed: they still await a reply next cycle.
+    """
+    replies, prompts = {}, {}
+    for k, history in histories.items():
+        messages = _build_messages(history)
+        if not messages: continue
+        handled, reply = _answer_locally(history, messages)
+        if not handled:
+            prompts[k] = messages
+        elif reply:
+            replies[k] = reply
+    if not prompts:
+        return replies
+
+    # Conversations with the same normalized prompt share one request
+    unique = {}
+    for k, messages in prompts.items():
+        unique.setdefault(ReplyCache.key(messages), messages)
+    generated = asyncio.run(_generate_all(unique))
+    for prompt_hash, reply in generated.items():
+        if reply:
+            reply_cache.put(unique[prompt_hash], reply)
+    for k, messages in prompts.items():
+        reply = generated.get(ReplyCache.key(messages))
+        if reply:
+            replies[k] = reply
+    return replies
+
+async def _generate_all(prompts):
+    # A fresh client per batch: asyncio.run gives every call its own event loop
+    async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=config.AI_REQUEST_TIMEOUT_SECONDS)
+    semaphore = asyncio.Semaphore(config.AI_MAX_CONCURRENCY)
     try:
-        print(f"   🧠 Sending prompt to GPT to reply to: '{last_content[:50]}...'")
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Best for bots: fast and very cheap
-            messages=messages,
-            temperature=0.7,
-            max_tokens=500
-        )
-        
-        ai_reply = response.choices[0].message.content.strip()
-        print(f"   🤖 GPT replied: '{ai_reply[:50]}...'")
-        
-        return ai_reply
-
-    except Exception as e:
-        print(f"   ❌ An error occurred with the OpenAI API: {e}")
-        return "Sorry, I'm having trouble thinking right now. Ahbab will get back to you soon."
\ No newline at end of file
+        print(f"   🧠 Generating {len(prompts)} replies ({config.AI_MAX_CONCURRENCY} at a time)...")
+        keys = list(prompts)
+        replies = await asyncio.gather(*(_generate_one(async_client, semaphore, prompts[k]) for k in keys))
+        return dict(zip(keys, replies))
+    finally:
+        await async_client.close()
+
+async def _generate_one(async_client, semaphore, messages):
+    """
+    One completion with a hard timeout and exponential backoff (with jitter) on
+    transient errors. Returns None if it never succeeds.
+    """
+    for attempt in range(config.AI_MAX_RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await asyncio.wait_for(async_client.chat.completions.create(
+                    model=config.AI_MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=500
+                ), timeout=config.AI_REQUEST_TIMEOUT_SECONDS)
+            ai_reply = response.choices[0].message.content.strip()
+            print(f"   🤖 GPT replied: '{ai_reply[:50]}...'")
+            return ai_reply
+        except RETRYABLE_ERRORS as e:
+            if attempt == config.AI_MAX_RETRIES:
+                print(f"   ❌ OpenAI API still failing after {attempt + 1} attempts: {e!r}")
+                break
+            delay = config.AI_RETRY_BASE_SECONDS * 2 ** attempt * (1 + random.random())
+            print(f"   ⏳ OpenAI API error ({type(e).__name__}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            print(f"   ❌ An error occurred with the OpenAI API: {e}")
+            break
+    return None
\ No newline at end of file
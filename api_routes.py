@@ -3,6 +3,7 @@ from flask import Flask, request, jsonify, current_app
 import database_manager as db
 import threading
 import selenium_handler as sh
+import browser_pool
 import time
 
 # api_routes.py
@@ -45,11 +46,12 @@ def sync_and_send_worker(number, text, file_path, your_name, lock):
     with lock:
         print("   ✅ Lock acquired. Starting browser operation.")
         driver = None
+        failed = False
         try:
             # Syncing logic is now only relevant if we are replying to an existing chat.
             # For sending a new message, we can simplify.
             
-            driver = sh.open_whatsapp()
+            driver = browser_pool.pool.lease("default", mode="sync")
             if not driver:
                 raise Exception("Failed to open WhatsApp. The task will be aborted.")
 
@@ -78,12 +80,13 @@ def sync_and_send_worker(number, text, file_path, your_name, lock):
             print(f"--- [API Task for {number} Finished Successfully] ---")
 
         except Exception as e:
+            failed = True
             print(f"--- [API Task for {number} FAILED] ---")
             print(f"   - Error: {e}")
         finally:
             if driver:
-                print("   - Closing API browser session.")
-                driver.quit()
+                print("   - Returning API browser session to the pool.")
+                browser_pool.pool.give_back("default", driver, discard=failed)
             print("   Releasing lock.")
 
 @app.route('/messages', methods=['POST'])
@@ -195,6 +198,7 @@ from flask import Flask, request, jsonify, render_template, current_app
 import selenium_handler as sh
 import bot_state # Requires bot_state.py (dictionary + lock)
 import storage_manager
+import database_manager
 
 # Ensure template folder is correct for Docker
 template_dir = os.path.abspath('templates')
@@ -204,6 +208,12 @@ app = Flask(__name__, template_folder=template_dir)
 def login_page():
     return render_template('login.html')
 
+def _release_login_lock():
+    """Releases the session lock taken by the login flow, if it still holds one."""
+    lock = bot_state.state.pop("login_lock", None)
+    if lock and lock.locked():
+        lock.release()
+
 # api_routes.py
 
 @app.route('/trigger-qr')
@@ -221,11 +231,12 @@ def trigger_qr():
 
     # 2. Define the background task
     def background_browser_launch(user_id):
-        # Try to acquire lock (Wait up to 10s if a Sync is finishing)
-        acquired = bot_state.BROWSER_LOCK.acquire(timeout=10)
-        if not acquired:
+        # Lock only this session (wait up to 10s if its sync is finishing); others keep syncing
+        session_lock = bot_state.get_session_lock(user_id)
+        if not session_lock.acquire(timeout=10):
             bot_state.state["status"] = "ERROR_BUSY"
             return
+        bot_state.state["login_lock"] = session_lock
 
         try:
             print(f"🚀 Starting Login Flow for: {user_id}")
@@ -237,9 +248,13 @@ def trigger_qr():
             if bot_state.state["driver"]:
                 try: bot_state.state["driver"].quit()
                 except: pass
+            # A warm sync browser would hold the same profile directory open
+            browser_pool.pool.evict(user_id)
+            # Restore an existing profile so re-logins keep their state
+            storage_manager.download_session(user_id)
 
             # Open Chrome with specific profile folder
-            driver = sh.open_whatsapp(headless=True, session_id=user_id)
+            driver = sh.open_whatsapp(headless=True, session_id=user_id, mode="login")
             
             if driver:
                 bot_state.state["driver"] = driver
@@ -256,8 +271,7 @@ def trigger_qr():
         except Exception as e:
             print(f"❌ Background Launch Error: {e}")
             bot_state.state["status"] = "ERROR_GENERIC"
-            if bot_state.BROWSER_LOCK.locked():
-                bot_state.BROWSER_LOCK.release()
+            _release_login_lock()
 
     # 3. Start the thread
     threading.Thread(target=background_browser_launch, args=(session_id,)).start()
@@ -275,7 +289,7 @@ def poll_qr():
         return jsonify({"status": "ready", "qr": qr})
     elif status.startswith("ERROR"):
         # If error, we must ensure lock is released
-        if bot_state.BROWSER_LOCK.locked(): bot_state.BROWSER_LOCK.release()
+        _release_login_lock()
         return jsonify({"status": "error", "message": "Server timed out or crashed."})
     elif status == "AUTHENTICATED":
         return jsonify({"status": "authenticated"})
@@ -298,17 +312,15 @@ def check_auth():
         # Wait for files to write to disk
         time.sleep(5)
         
-        # Upload the specific user's zip
-        current_user = bot_state.state.get("current_user")
-        storage_manager.upload_session(current_user)
-        
-        # Clean up
+        # Clean up; Chrome must be closed before its profile is saved
         driver.quit()
         bot_state.state["driver"] = None
+
+        # Upload the specific user's profile
+        current_user = bot_state.state.get("current_user")
+        storage_manager.upload_session(current_user)
         bot_state.state["status"] = "IDLE"
-        
-        if bot_state.BROWSER_LOCK.locked():
-            bot_state.BROWSER_LOCK.release()
+        _release_login_lock()
             
         return jsonify({"status": "authenticated"})
     
@@ -317,4 +329,14 @@ def check_auth():
 @app.route('/send-message', methods=['POST'])
 def send_message():
     """API to send messages (Not implemented for Multi-User in this snippet)"""
-    return jsonify({"status": "info", "message": "Use the automated sync loop for replies."})
\ No newline at end of file
+    return jsonify({"status": "info", "message": "Use the automated sync loop for replies."})
+
+@app.route('/api/attachments/<int:ref_id>/fetch', methods=['POST'])
+def fetch_attachment(ref_id):
+    """Queues a deferred attachment for download the next time its session's browser is open."""
+    ref = database_manager.request_attachment_fetch(ref_id)
+    if not ref:
+        return jsonify({"status": "error", "message": "Unknown attachment."}), 404
+    if ref["status"] == "fetched":
+        return jsonify({"status": "fetched", "attachment_filename": ref["attachment_filename"]})
+    return jsonify({"status": ref["status"], "session_id": ref["session_id"], "target_name": ref["target_name"]}), 202
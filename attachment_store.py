@@ -0,0 +1,76 @@
+# attachment_store.py
+import os
+import hashlib
+import mimetypes
+import threading
+import config
+import database_manager
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _object_path(content_hash):
+    """objects/<first 2 hex>/<hash>: spreads files over 256 folders. Names and mime live in the DB."""
+    return os.path.join(config.ATTACHMENT_OBJECTS_DIR, content_hash[:2], content_hash)
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _register(content_hash, size_bytes, original_name, stored_path, media_key):
+    mime_type = mimetypes.guess_type(original_name or "")[0]
+    database_manager.save_attachment(content_hash, size_bytes, mime_type, os.path.relpath(stored_path, config.ATTACHMENTS_DIR))
+    database_manager.save_attachment_name(media_key or content_hash, content_hash, original_name)
+
+
+def store_file(path, original_name, media_key=None):
+    """
+    Moves a finished download into the content-addressed store and returns its hash.
+    If identical content is already stored, the new copy is simply deleted.
+    """
+    content_hash = hash_file(path)
+    stored_path = _object_path(content_hash)
+    size_bytes = os.path.getsize(path)
+    if os.path.exists(stored_path):
+        os.remove(path)
+        print(f"   -> ♻️ '{original_name}' is already stored ({content_hash[:12]}).")
+    else:
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        os.replace(path, stored_path)
+    _register(content_hash, size_bytes, original_name, stored_path, media_key)
+    return content_hash
+
+
+def store_bytes(data, original_name, media_key=None):
+    """Same as store_file for content that is already in memory (e.g. a fetched blob:)."""
+    content_hash = hashlib.blake2b(data, digest_size=32).hexdigest()
+    stored_path = _object_path(content_hash)
+    if not os.path.exists(stored_path):
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        tmp_path = f"{stored_path}.{threading.get_ident()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, stored_path)
+    _register(content_hash, len(data), original_name, stored_path, media_key)
+    return content_hash
+
+
+def lookup(media_key):
+    """Returns the stored attachment of the message with this key (hash, size, mime, path, original name), or None."""
+    return database_manager.get_attachment_for_key(media_key) if media_key else None
+
+
+def is_stored(media_key):
+    """True when the attachment of the message with this key is already in the store."""
+    return lookup(media_key) is not None
+
+
+def path_for(media_key):
+    """Returns the absolute path of a message's stored attachment, or None."""
+    attachment = lookup(media_key)
+    return os.path.join(config.ATTACHMENTS_DIR, attachment["stored_path"]) if attachment else None
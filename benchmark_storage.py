@@ -0,0 +1,104 @@
+# benchmark_storage.py
+"""
+Measures profile save/restore throughput offline, against the local storage backend.
+
+Builds synthetic Chrome-like profiles of the requested sizes in a temporary folder,
+then times, for each profile sync strategy: the first upload, an upload with
+nothing changed, and a cold restore into an empty profiles/ folder.
+
+    python benchmark_storage.py --sizes 20 100 300 --strategies manifest archive
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import config
+
+# Chrome-ish layout: a few big IndexedDB/leveldb files, many small ones, and a cache
+# folder that profile slimming skips
+LAYOUT = [
+    ("Default/IndexedDB/https_web.whatsapp.com_0.indexeddb.leveldb/{i:06d}.ldb", 0.55, 2 * 1024 * 1024),
+    ("Default/Service Worker/CacheStorage/{i:04d}_0", 0.15, 256 * 1024),
+    ("Default/Local Storage/leveldb/{i:06d}.log", 0.05, 64 * 1024),
+    ("Default/Cache/Cache_Data/f_{i:06d}", 0.25, 128 * 1024),
+]
+TEXT = b'{"type":"chat","body":"see you tomorrow","t":1700000000,"ack":3}\n'
+
+
+def build_profile(path, size_mb):
+    """Writes ~size_mb of files, half random (media, keys) and half compressible (JSON, logs)."""
+    total = size_mb * 1024 * 1024
+    for pattern, share, file_size in LAYOUT:
+        budget, i = int(total * share), 0
+        while budget > 0:
+            n = min(file_size, budget)
+            dest = os.path.join(path, *pattern.format(i=i).split("/"))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as f:
+                f.write(os.urandom(n // 2) + (TEXT * (n // len(TEXT) + 1))[:n - n // 2])
+            budget -= n
+            i += 1
+    with open(os.path.join(path, "Local State"), "w") as f:
+        f.write('{"profile": {"info_cache": {}}}')
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    ok = fn(*args)
+    return time.perf_counter() - start, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 100], help="profile sizes in MB")
+    parser.add_argument("--strategies", nargs="+", default=["manifest", "archive"], choices=["manifest", "archive"])
+    parser.add_argument("--keep", action="store_true", help="keep the temporary folder for inspection")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="storage-bench-")
+    config.STORAGE_BACKEND = "local"
+    config.STORAGE_LOCAL_DIR = os.path.join(work_dir, "bucket")
+    config.PROFILE_CACHE_MAX_MB = 0
+    os.chdir(work_dir)  # profiles/ is relative to the working directory
+    import storage_manager
+
+    rows = []
+    try:
+        for size_mb in args.sizes:
+            source = os.path.join(work_dir, f"source-{size_mb}")
+            print(f"🛠️ Building a {size_mb} MB synthetic profile...")
+            build_profile(source, size_mb)
+            for strategy in args.strategies:
+                config.PROFILE_SYNC_STRATEGY = strategy
+                session_id = f"bench-{size_mb}-{strategy}"
+                local_dir = os.path.join(storage_manager.PROFILES_DIR, session_id)
+                shutil.copytree(source, local_dir)
+
+                stored_before = storage_manager._dir_size(config.STORAGE_LOCAL_DIR)
+                upload_s, ok = timed(storage_manager.upload_session, session_id)
+                stored = storage_manager._dir_size(config.STORAGE_LOCAL_DIR) - stored_before
+                unchanged_s, _ = timed(storage_manager.upload_session, session_id)
+                shutil.rmtree(local_dir)
+                restore_s, restored = timed(storage_manager.download_session, session_id)
+                if not (ok and restored):
+                    print(f"❌ {session_id} failed.")
+                    continue
+                rows.append((size_mb, strategy, stored, upload_s, unchanged_s, restore_s))
+    finally:
+        if args.keep:
+            print(f"📂 Kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"\n{'size':>6} {'strategy':<9} {'stored':>9} {'upload':>14} {'unchanged':>10} {'restore':>14}")
+    for size_mb, strategy, stored, upload_s, unchanged_s, restore_s in rows:
+        print(f"{size_mb:>4}MB {strategy:<9} {stored / 1e6:>7.1f}MB "
+              f"{upload_s:>6.2f}s {size_mb / upload_s:>5.0f}MB/s {unchanged_s:>9.2f}s "
+              f"{restore_s:>6.2f}s {size_mb / restore_s:>5.0f}MB/s")
+    return 0 if len(rows) == len(args.sizes) * len(args.strategies) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,8 +6,15 @@ state = {
     "status": "BOOTING",      # BOOTING, IDLE, LOGIN_MODE, AUTHENTICATED
     "qr_code": None,          # Stores the Base64 QR image
     "driver": None,           # Holds the Selenium Driver instance
+    "login_lock": None,       # Session lock held by the login flow
     "last_sync": 0
 }
 
-# A lock to ensure only one thread touches the browser at a time
-BROWSER_LOCK = threading.Lock()
\ No newline at end of file
+# One lock per session: a session's profile and browser are used by one task at a
+# time (sync, login, send), while different sessions run side by side.
+_session_locks = {}
+_session_locks_guard = threading.Lock()
+
+def get_session_lock(session_id):
+    with _session_locks_guard:
+        return _session_locks.setdefault(session_id, threading.Lock())
\ No newline at end of file
@@ -0,0 +1,192 @@
+# browser_pool.py
+import os
+import time
+import threading
+from collections import OrderedDict
+from selenium.common.exceptions import WebDriverException
+import config
+import download_manager
+import selenium_handler as sh
+
+
+def _process_tree_rss_mb(root_pid):
+    """
+    Resident memory of a process and all its descendants, read from /proc.
+    Shared pages are counted once per process, so this errs on the high side.
+    Returns 0 where /proc is unavailable.
+    """
+    try:
+        children = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit(): continue
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(pid))
+
+        pages, stack = 0, [root_pid]
+        while stack:
+            pid = stack.pop()
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    pages += int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+            stack.extend(children.get(pid, []))
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class BrowserPool:
+    """
+    Keeps WhatsApp Web warm for the most recently used sessions so a cycle can
+    skip Chrome start-up and app hydration. Callers lease a session's driver,
+    use it exclusively, and give it back; idle drivers are closed least recently
+    used first when the pool exceeds its size or memory budget, or sits idle too long.
+    While a browser is open its profile is live on disk, so on_close (if set) is
+    called with the session id once Chrome has quit, e.g. to save the profile. An
+    idle browser open longer than checkpoint_seconds is closed for that reason too.
+    Call trim() periodically so idle limits apply without waiting for a give_back.
+    """
+
+    def __init__(self, max_size, memory_budget_mb=0, idle_seconds=0, checkpoint_seconds=0):
+        self.max_size = max_size
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_seconds = idle_seconds
+        self.checkpoint_seconds = checkpoint_seconds
+        self.entries = OrderedDict()  # session_id -> {"driver", "mode", "leased", "last_used", "opened"}, LRU first
+        self.lock = threading.Lock()
+        self.on_close = None
+
+    def lease(self, session_id, mode="sync", headless=True):
+        """
+        Returns a ready driver for session_id, reusing the warm one when it is healthy
+        and was launched in the same mode. Returns None if a browser can't be opened.
+        """
+        stale = None
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry and entry["leased"]:
+                raise RuntimeError(f"Browser for '{session_id}' is already leased.")
+            if entry and entry["mode"] == mode:
+                entry["leased"] = True
+                self.entries.move_to_end(session_id)
+            elif entry:
+                stale = self.entries.pop(session_id)
+                entry = None
+
+        if stale:
+            self._close(session_id, stale)
+        if entry:
+            if self._healthy(entry["driver"]):
+                print(f"   ♨️ Reusing warm browser for {session_id}")
+                return entry["driver"]
+            print(f"   ⚠️ Warm browser for {session_id} failed its health check. Relaunching...")
+            with self.lock:
+                self.entries.pop(session_id, None)
+            self._close(session_id, entry)
+
+        driver = sh.open_whatsapp(headless=headless, session_id=session_id, mode=mode)
+        if not driver:
+            return None
+        with self.lock:
+            self.entries[session_id] = {"driver": driver, "mode": mode, "leased": True, "last_used": time.time(), "opened": time.time()}
+        return driver
+
+    def give_back(self, session_id, driver, discard=False):
+        """
+        Returns a leased driver to the pool. Pass discard=True when the lease ended in an
+        error so the browser is closed instead of being reused in an unknown state.
+        """
+        download_manager.drain_download_queue(driver)
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry and entry["driver"] is driver:
+                entry["leased"] = False
+                entry["last_used"] = time.time()
+        if discard or not self._healthy(driver):
+            self.evict(session_id)
+        self.trim()
+
+    def evict(self, session_id):
+        """Closes a session's idle browser, e.g. before another Chrome opens the same profile."""
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if not entry or entry["leased"]:
+                return False
+            del self.entries[session_id]
+        self._close(session_id, entry)
+        return True
+
+    def trim(self):
+        """Closes idle browsers, least recently used first, until the pool fits its limits."""
+        now = time.time()
+        with self.lock:
+            sizes = {sid: self._memory_mb(e["driver"]) for sid, e in self.entries.items()} if self.memory_budget_mb else {}
+            usage = sum(sizes.values())
+            count = len(self.entries)
+            to_close = []
+            for session_id, entry in list(self.entries.items()):
+                if entry["leased"]: continue
+                over_size = count > self.max_size
+                over_budget = self.memory_budget_mb and usage > self.memory_budget_mb
+                expired = self.idle_seconds and now - entry["last_used"] > self.idle_seconds
+                unsaved = self.checkpoint_seconds and now - entry["opened"] > self.checkpoint_seconds
+                if not (over_size or over_budget or expired or unsaved): continue
+                to_close.append((session_id, self.entries.pop(session_id)))
+                usage -= sizes.get(session_id, 0)
+                count -= 1
+        for session_id, entry in to_close:
+            self._close(session_id, entry)
+
+    def close_all(self):
+        with self.lock:
+            entries = list(self.entries.items())
+            self.entries.clear()
+        for session_id, entry in entries:
+            self._close(session_id, entry)
+
+    def is_open(self, session_id):
+        """True while a browser (leased or warm) has the session's profile open."""
+        with self.lock:
+            return session_id in self.entries
+
+    def memory_usage_mb(self):
+        with self.lock:
+            drivers = [e["driver"] for e in self.entries.values()]
+        return sum(self._memory_mb(driver) for driver in drivers)
+
+    @staticmethod
+    def _memory_mb(driver):
+        try:
+            return _process_tree_rss_mb(driver.service.process.pid)
+        except AttributeError:
+            return 0
+
+    @staticmethod
+    def _healthy(driver):
+        try:
+            return "web.whatsapp.com" in driver.current_url and driver.execute_script("return document.readyState") == "complete"
+        except WebDriverException:
+            return False
+
+    def _close(self, session_id, entry):
+        try:
+            download_manager.drain_download_queue(entry["driver"])
+            entry["driver"].quit()
+        except WebDriverException:
+            pass
+        print(f"   🔒 Closed browser for {session_id}")
+        if self.on_close:
+            self.on_close(session_id)
+
+
+pool = BrowserPool(
+    config.BROWSER_POOL_SIZE,
+    memory_budget_mb=config.BROWSER_POOL_MEMORY_BUDGET_MB,
+    idle_seconds=config.BROWSER_POOL_IDLE_SECONDS,
+    checkpoint_seconds=config.BROWSER_POOL_CHECKPOINT_SECONDS,
+)
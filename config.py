@@ -7,6 +7,117 @@ import os
 YOUR_WHATSAPP_NAME = "AHBAB SAKALAN"
 
 ATTACHMENTS_DIR = os.path.join(os.getcwd(), "attachments")
+# Downloaded files are stored once, under their content hash
+ATTACHMENT_OBJECTS_DIR = os.path.join(ATTACHMENTS_DIR, "objects")
+
+# ==============================================================================
+# --- BROWSER SETTINGS ---
+# ==============================================================================
+# Set CHROMEDRIVER_PATH to pin a specific driver binary. Otherwise the path
+# resolved by webdriver-manager is cached in this file and reused across runs.
+CHROMEDRIVER_PATH = os.getenv("CHROMEDRIVER_PATH")
+CHROMEDRIVER_CACHE_FILE = os.path.join(os.getcwd(), ".chromedriver_path.json")
+
+# Warm browsers kept open between cycles (see browser_pool.py). Idle browsers are
+# closed least recently used first when the pool holds more than BROWSER_POOL_SIZE,
+# their memory exceeds the budget (0 = no budget), or they sit idle too long.
+# Use at least SYNC_WORKERS to keep every parallel session warm.
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+BROWSER_POOL_MEMORY_BUDGET_MB = int(os.getenv("BROWSER_POOL_MEMORY_BUDGET_MB", "0"))
+BROWSER_POOL_IDLE_SECONDS = 3600
+# A profile is only saved once its browser closes, so an idle warm browser open
+# longer than this is closed at its next idle moment to checkpoint the profile.
+BROWSER_POOL_CHECKPOINT_SECONDS = 1800
+
+# Sessions synced in parallel, each in its own Chrome. 0 derives it from the CPU
+# count and available RAM, budgeting SYNC_WORKER_RAM_MB per browser.
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "0"))
+SYNC_WORKER_RAM_MB = 450
+
+# Profiles of the next PREFETCH_SESSIONS sessions due within PREFETCH_HORIZON_SECONDS
+# are downloaded while others sync, and finished sessions are uploaded in the
+# background (see profile_transfers.py). A prefetched copy older than the horizon
+# is checked against storage again.
+PROFILE_TRANSFER_WORKERS = 2
+PREFETCH_SESSIONS = 2
+PREFETCH_HORIZON_SECONDS = 120
+# A session's lock can be held for minutes by a login waiting on its QR code. An
+# upload gives up after PROFILE_UPLOAD_LOCK_TIMEOUT_SECONDS (the next sync or the
+# login saves the profile), and a sync skips a session whose transfer is still
+# running after PROFILE_TRANSFER_WAIT_SECONDS.
+PROFILE_UPLOAD_LOCK_TIMEOUT_SECONDS = 60
+PROFILE_TRANSFER_WAIT_SECONDS = 120
+
+# open_whatsapp launch profiles: "login" loads everything (the QR code needs it),
+# "sync" blocks the request patterns below. Attachment downloads use other URLs.
+SYNC_BLOCKED_URL_PATTERNS = [
+    "*://pps.whatsapp.net/*",   # profile pictures in the chat list and headers
+    "*/v/t62.15575-24/*",       # stickers
+]
+
+# Attachment downloads finish while scraping continues: the queue is checked between
+# scroll steps (on the thread driving the browser) and drained once per session.
+# Each check reads up to MEDIA_DOWNLOAD_CONCURRENCY in-page blobs in parallel.
+# A download that fails or times out is recorded as a failed attachment reference.
+MEDIA_DOWNLOAD_CONCURRENCY = 3
+MEDIA_DOWNLOAD_QUEUE_SIZE = 32
+MEDIA_DOWNLOAD_TIMEOUT_SECONDS = 45
+MEDIA_DOWNLOAD_DRAIN_TIMEOUT_SECONDS = 120
+
+# Other attachments are only recorded during sync and fetched on demand through
+# POST /api/attachments/<id>/fetch. Kinds: "image", "video", "document".
+# Attachments whose size can't be read from the bubble count as small.
+ATTACHMENT_EAGER_TYPES = {"image", "document"}
+ATTACHMENT_EAGER_MAX_BYTES = 2 * 1024 * 1024
+ATTACHMENT_FETCH_BATCH_SIZE = 10
+
+# ==============================================================================
+# --- PROFILE STORAGE ---
+# ==============================================================================
+# Where profiles are stored: "supabase" (bucket STORAGE_BUCKET, credentials from
+# SUPABASE_URL/SUPABASE_KEY) or "local" (a folder, for offline runs and benchmarks)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+STORAGE_BUCKET = "whatsapp_data"
+STORAGE_LOCAL_DIR = os.getenv("STORAGE_LOCAL_DIR", "storage")
+
+# "manifest": upload only changed chunks of each Chrome profile plus a small
+# manifest per session. "archive": stream the whole profile as one compressed tar
+# (zstd if the zstandard package is installed, gzip otherwise).
+# Sessions saved as legacy <session_id>.zip are still restored under either strategy.
+PROFILE_SYNC_STRATEGY = os.getenv("PROFILE_SYNC_STRATEGY", "manifest")
+PROFILE_CHUNK_SIZE = 1024 * 1024
+# Chunks no manifest references any more are deleted by a mark-and-sweep that runs
+# after a manifest upload at most every PROFILE_CHUNK_GC_INTERVAL_SECONDS. Chunks
+# younger than the grace period are kept: a save uploads its chunks before its manifest.
+PROFILE_CHUNK_GC_INTERVAL_SECONDS = 6 * 3600
+PROFILE_CHUNK_GC_GRACE_SECONDS = 24 * 3600
+PROFILE_ARCHIVE_LEVEL = 3
+# Disk budget for profiles kept locally between cycles; least recently used ones
+# are deleted above it (0 = keep everything)
+PROFILE_CACHE_MAX_MB = int(os.getenv("PROFILE_CACHE_MAX_MB", "0"))
+
+# What gets saved from a profile (paths relative to profiles/<session_id>, fnmatch
+# patterns matched against the path and each of its parent folders).
+# "denylist" saves everything except PROFILE_EXCLUDE; "minimal" saves only
+# PROFILE_MINIMAL_SET, the state WhatsApp Web needs to come back logged in.
+PROFILE_SLIM_MODE = os.getenv("PROFILE_SLIM_MODE", "denylist")
+PROFILE_EXCLUDE = [
+    "*/Cache", "*/Code Cache", "*/GPUCache", "*/DawnCache", "*/DawnGraphiteCache",
+    "*/Service Worker/CacheStorage", "*/Service Worker/ScriptCache",
+    "GrShaderCache", "ShaderCache", "GraphiteDawnCache",
+    "Crashpad", "BrowserMetrics", "*.pma",
+    "component_crx_cache", "extensions_crx_cache", "optimization_guide_model_store",
+    "Safe Browsing", "*/blob_storage", "*/Download Service",
+]
+PROFILE_MINIMAL_SET = [
+    "Local State",
+    "*/Preferences", "*/Secure Preferences",
+    "*/Cookies", "*/Cookies-journal", "*/Network/Cookies", "*/Network/Cookies-journal",
+    "*/Local Storage", "*/Session Storage",
+    "*/IndexedDB/https_web.whatsapp.com_0.indexeddb.leveldb",
+    "*/IndexedDB/https_web.whatsapp.com_0.indexeddb.blob",
+    "*/Service Worker/Database",
+]
 
 # ==============================================================================
 # --- AI SETTINGS ---
@@ -32,10 +143,52 @@ SYSTEM_PROMPT = """
 
 # The SIMULATED_AI_REPLIES list is no longer needed.
 
+AI_MODEL = "gpt-4o-mini"  # Best for bots: fast and very cheap
+AI_HISTORY_MESSAGES = 15
+# Prompt size limits (tokens, counted locally with tiktoken when installed). The
+# history budget excludes SYSTEM_PROMPT, which is always sent first and unchanged.
+AI_PROMPT_TOKEN_BUDGET = 1500
+AI_MAX_MESSAGE_TOKENS = 400
+# Replies for a backlog are generated concurrently (see ai_manager.generate_replies)
+AI_MAX_CONCURRENCY = 8
+AI_REQUEST_TIMEOUT_SECONDS = 30
+AI_MAX_RETRIES = 3
+AI_RETRY_BASE_SECONDS = 1
+# Fast path: when the user's latest messages are all trivial (each fully matches one
+# of these regexes after lowercasing and dropping punctuation/emoji), the first
+# matching rule's reply is used without calling the model. reply=None means the
+# message needs no answer. Rules are checked in order.
+FAST_PATH_ENABLED = True
+FAST_PATH_RULES = [
+    {"intent": "salam", "patterns": [r"(as+)?sala+m+( ?[ou]? ?(w|a)?alai?ku+m+)?", r"slm+", r"assalamu ?alaikum( wa ?rahmatullah.*)?"],
+     "reply": f"Walaikum assalam! {YOUR_WHATSAPP_NAME} has received your message and will get back to you soon."},
+    {"intent": "greeting", "patterns": [r"h+i+", r"he+y+", r"hel+o+", r"good (morning|afternoon|evening|night)"],
+     "reply": f"Hello! {YOUR_WHATSAPP_NAME} has received your message and will get back to you shortly."},
+    {"intent": "ack", "patterns": [r"o+k+a*y*", r"k+", r"th(a|e)nk(s| you| u)?", r"ty", r"dhonn?o?bad", r"acc?h+a+", r"h+m+", r"ji+"],
+     "reply": None},
+]
+
+# Model replies are cached in SQLite, keyed on a hash of the full prompt (system
+# prompt + normalized recent history), so an identical prompt is never paid twice
+REPLY_CACHE_MAX_ENTRIES = 2000
+REPLY_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Reply preparation runs after each sync without a browser; finished replies wait
+# in the PendingReplies table for the session's next (immediately scheduled) sync
+REPLY_PREPARE_WORKERS = 1
+
 # ==============================================================================
 # --- SCHEDULER TIMINGS (in seconds) ---
 # ==============================================================================
-SYNC_INTERVAL_SECONDS = 600
+SYNC_INTERVAL_SECONDS = 600  # starting interval for a session with no history yet
+# Adaptive per-session intervals (see session_scheduler.py): each session is
+# revisited after about SYNC_TARGET_MESSAGES new messages at its observed rate,
+# never sooner than the minimum nor later than the maximum.
+SYNC_MIN_INTERVAL_SECONDS = 60
+SYNC_MAX_INTERVAL_SECONDS = 3600
+SYNC_TARGET_MESSAGES = 5
+SYNC_RATE_SMOOTHING = 0.3
+SESSION_LIST_REFRESH_SECONDS = 300
 REPLY_INTERVAL_SECONDS = 900
 REPLY_API_TASK_DELAY_SECONDS = 30
 REPLY_MAX_AGE_DAYS = 30
\ No newline at end of file
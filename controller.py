@@ -15,9 +15,9 @@ def init_db():
         print(f"❌ API Error: Could not initialize database. Is the server running? Error: {e}")
 
 def save_messages_to_db(contact_name, phone_number, new_messages):
-    """Calls the API to save new messages."""
+    """Calls the API to save new messages. Returns False if they were not stored."""
     if not new_messages:
-        return
+        return True
     payload = {
         "contact_name": contact_name,
         "phone_number": phone_number,
@@ -28,8 +28,10 @@ def save_messages_to_db(contact_name, phone_number, new_messages):
         response = requests.post(f"{API_BASE_URL}/messages", json=payload)
         response.raise_for_status()
         print(f"📡 Sent {len(new_messages)} messages for '{contact_name}' to API for saving.")
+        return True
     except requests.exceptions.RequestException as e:
         print(f"❌ API Error: Could not save messages for '{contact_name}'. Error: {e}")
+        return False
 
 def get_last_message_from_db(phone_number, title, your_name):
     """Calls the API to get the last message's meta_text."""
@@ -44,9 +44,122 @@ def init_db():
         stored_date TEXT NOT NULL,
         meta_text TEXT UNIQUE,
         attachment_filename TEXT, -- <-- NEW COLUMN
+        attachment_key TEXT, -- media key into AttachmentNames
         FOREIGN KEY (conversation_id) REFERENCES Conversations (id)
     );
     """)
+
+    # Older databases keyed snapshots by title alone; move them aside and copy them over below
+    snapshot_columns = {row['name'] for row in cursor.execute("PRAGMA table_info(ChatListSnapshots)")}
+    legacy_snapshots = snapshot_columns and 'chat_key' not in snapshot_columns
+    if legacy_snapshots:
+        cursor.execute("ALTER TABLE ChatListSnapshots RENAME TO ChatListSnapshotsLegacy")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ChatListSnapshots (
+        session_id TEXT NOT NULL,
+        chat_key TEXT NOT NULL, -- the row's chat id when known, else its title
+        title TEXT NOT NULL,
+        chat_id TEXT,
+        preview TEXT,
+        timestamp TEXT,
+        unread INTEGER DEFAULT 0,
+        updated TEXT NOT NULL,
+        PRIMARY KEY (session_id, chat_key)
+    );
+    """)
+    if legacy_snapshots:
+        cursor.execute("""INSERT INTO ChatListSnapshots (session_id, chat_key, title, preview, timestamp, unread, updated)
+                          SELECT session_id, title, title, preview, timestamp, unread, updated FROM ChatListSnapshotsLegacy""")
+        cursor.execute("DROP TABLE ChatListSnapshotsLegacy")
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ChatIdentities (
+        session_id TEXT NOT NULL,
+        title TEXT NOT NULL,
+        contact_name TEXT NOT NULL,
+        phone_number TEXT,
+        chat_id TEXT,
+        updated TEXT NOT NULL,
+        PRIMARY KEY (session_id, title)
+    );
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS AttachmentRefs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        chat_title TEXT NOT NULL,
+        media_key TEXT NOT NULL,
+        message_id TEXT,
+        meta_text TEXT,
+        kind TEXT NOT NULL,
+        target_name TEXT NOT NULL,
+        size_bytes INTEGER,
+        status TEXT NOT NULL DEFAULT 'deferred', -- deferred | requested | fetched | failed
+        attachment_filename TEXT,
+        created TEXT NOT NULL,
+        updated TEXT NOT NULL,
+        UNIQUE (session_id, media_key)
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachment_refs_status ON AttachmentRefs (session_id, status);")
+
+    # Content-addressed attachment store: one row per distinct file, plus the name
+    # each message's attachment arrived under (keyed by the message's media key).
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Attachments (
+        content_hash TEXT PRIMARY KEY,
+        size_bytes INTEGER NOT NULL,
+        mime_type TEXT,
+        stored_path TEXT NOT NULL,
+        created TEXT NOT NULL
+    );
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS AttachmentNames (
+        media_key TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        original_name TEXT,
+        created TEXT NOT NULL,
+        FOREIGN KEY (content_hash) REFERENCES Attachments (content_hash)
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachment_names_hash ON AttachmentNames (content_hash);")
+
+    # AI replies generated outside the browser, waiting for a session's browser to send them.
+    # reply_to_index is the message_index of the message being answered.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS PendingReplies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        conversation_id INTEGER NOT NULL,
+        reply_to_index INTEGER NOT NULL,
+        reply TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending', -- pending | sent | stale
+        created TEXT NOT NULL,
+        updated TEXT NOT NULL,
+        UNIQUE (conversation_id, reply_to_index),
+        FOREIGN KEY (conversation_id) REFERENCES Conversations (id)
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_replies_status ON PendingReplies (session_id, status);")
+
+    # LLM replies keyed on a hash of the prompt that produced them (see ai_manager.ReplyCache)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ReplyCache (
+        prompt_hash TEXT PRIMARY KEY,
+        reply TEXT NOT NULL,
+        created TEXT NOT NULL,
+        last_used TEXT NOT NULL
+    );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reply_cache_last_used ON ReplyCache (last_used);")
+
+    # Older databases predate the attachment_key column
+    columns = {row['name'] for row in cursor.execute("PRAGMA table_info(Messages)")}
+    if 'attachment_key' not in columns:
+        cursor.execute("ALTER TABLE Messages ADD COLUMN attachment_key TEXT")
     conn.commit()
     conn.close()
     print("🗄️ Database initialized successfully with robust schema.")
@@ -88,10 +201,10 @@ def save_messages_to_db(contact_name, phone_number, new_messages):
         # --- MODIFIED INSERT STATEMENT ---
         cursor.execute(
             """INSERT OR IGNORE INTO Messages (conversation_id, role, sender_name, content, message_index, 
-               sending_date, stored_date, meta_text, attachment_filename) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+               sending_date, stored_date, meta_text, attachment_filename, attachment_key) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             (conversation_id, role, sender_name, msg['content'], current_size + messages_added + 1, 
-             sending_date_iso, datetime.datetime.now().isoformat(), msg['meta_text'], attachment)
+             sending_date_iso, datetime.datetime.now().isoformat(), msg['meta_text'], attachment, msg.get('attachment_key'))
         )
         if cursor.rowcount > 0:
             messages_added += 1
@@ -175,6 +288,7 @@ def get_all_unreplied_conversations():
     # --- MODIFIED QUERY: Fetches the actual sending_date of the last message ---
     cursor.execute("""
         SELECT 
+            c.id as conversation_id,
             c.title, 
             c.phone_number, 
             (SELECT m.sending_date FROM Messages m WHERE m.conversation_id = c.id ORDER BY m.message_index DESC LIMIT 1) as last_message_date
@@ -197,6 +311,28 @@ def get_recent_messages_for_prompt(phone_number, count=10):
     conn.close()
     return reversed(messages)
 
+def get_prompt_histories(conversation_ids, count=15):
+    """
+    Recent messages of several conversations in one query, oldest first:
+    {conversation_id: [{"role", "content"}, ...]}.
+    """
+    ids = list(conversation_ids)
+    if not ids: return {}
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT conversation_id, role, content FROM (
+            SELECT m.conversation_id, m.role, m.content, m.message_index,
+                   ROW_NUMBER() OVER (PARTITION BY m.conversation_id ORDER BY m.message_index DESC) AS recency
+            FROM Messages m WHERE m.conversation_id IN ({",".join("?" * len(ids))})
+        ) WHERE recency <= ? ORDER BY conversation_id, message_index
+    """, (*ids, count))
+    histories = {conversation_id: [] for conversation_id in ids}
+    for row in cursor.fetchall():
+        histories[row["conversation_id"]].append({"role": row["role"], "content": row["content"]})
+    conn.close()
+    return histories
+
 def get_contact_details_by_phone(phone_number):
     """
     Finds a conversation and returns its title and the meta_text of the last message.
@@ -245,4 +381,327 @@ def get_existing_attachments_from_db():
         print(f"   -> ⚠️ Database error while fetching attachments: {e}")
         return set() # Return an empty set on error
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+
+# --- Chat List Snapshots ---
+def chat_list_key(row):
+    """Snapshot key of a chat-list row: its chat id, so chats sharing a display name stay apart."""
+    return row.get('chat_id') or row['title']
+
+def get_chat_list_snapshot(session_id):
+    """Returns the last stored chat-list rows for a session, keyed by chat_list_key."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_key, title, chat_id, preview, timestamp, unread, updated FROM ChatListSnapshots WHERE session_id = ?", (session_id,))
+    snapshot = {row['chat_key']: dict(row) for row in cursor.fetchall()}
+    conn.close()
+    return snapshot
+
+def save_chat_list_snapshot(session_id, rows):
+    """Upserts the given chat-list rows as the session's current snapshot."""
+    if not rows: return
+    conn = get_db_connection()
+    now_iso = datetime.datetime.now().isoformat()
+    # A row now known by chat id replaces the title-keyed row stored before ids were read
+    conn.executemany(
+        "DELETE FROM ChatListSnapshots WHERE session_id = ? AND chat_key = ? AND chat_id IS NULL",
+        [(session_id, r['title']) for r in rows if r.get('chat_id')]
+    )
+    conn.executemany(
+        """INSERT INTO ChatListSnapshots (session_id, chat_key, title, chat_id, preview, timestamp, unread, updated)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (session_id, chat_key) DO UPDATE SET
+               title = excluded.title, preview = excluded.preview, timestamp = excluded.timestamp,
+               unread = excluded.unread, updated = excluded.updated""",
+        [(session_id, chat_list_key(r), r['title'], r.get('chat_id'), r.get('preview'), r.get('timestamp'), r.get('unread', 0), now_iso) for r in rows]
+    )
+    conn.commit()
+    conn.close()
+
+
+# --- Chat Identity Cache ---
+def get_chat_identity(session_id, title, chat_id=None):
+    """
+    Returns the cached title/name/number/chat id for a chat, or None if unknown. The
+    chat id (the chat-list row's data-id) is tried first, so a renamed chat is still found.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    identity = None
+    if chat_id:
+        cursor.execute("SELECT title, contact_name, phone_number, chat_id FROM ChatIdentities WHERE session_id = ? AND chat_id = ?", (session_id, chat_id))
+        identity = cursor.fetchone()
+    if not identity:
+        cursor.execute("SELECT title, contact_name, phone_number, chat_id FROM ChatIdentities WHERE session_id = ? AND title = ?", (session_id, title))
+        identity = cursor.fetchone()
+    conn.close()
+    return dict(identity) if identity else None
+
+def save_chat_identity(session_id, title, contact_name, phone_number, chat_id=None):
+    """
+    Caches what the contact-info panel resolved for a chat-list title. Without the row's
+    chat id one is derived from the number. A chat has one entry: saving it under a new
+    title replaces the entry for its old title.
+    """
+    normalized_number = normalize_phone_number(phone_number)
+    digits = re.sub(r'\D', '', normalized_number) if normalized_number else ''
+    chat_id = chat_id or (f"{digits}@c.us" if digits else None)
+    conn = get_db_connection()
+    if chat_id:
+        conn.execute("DELETE FROM ChatIdentities WHERE session_id = ? AND chat_id = ? AND title != ?", (session_id, chat_id, title))
+    conn.execute(
+        """INSERT INTO ChatIdentities (session_id, title, contact_name, phone_number, chat_id, updated)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT (session_id, title) DO UPDATE SET
+               contact_name = excluded.contact_name, phone_number = excluded.phone_number,
+               chat_id = excluded.chat_id, updated = excluded.updated""",
+        (session_id, title, contact_name, normalized_number, chat_id, datetime.datetime.now().isoformat())
+    )
+    conn.commit()
+    conn.close()
+
+
+# --- Deferred Attachments ---
+def save_attachment_refs(session_id, chat_title, messages):
+    """Stores a reference for every message whose attachment was not downloaded during sync."""
+    refs = [m for m in messages if m.get('attachment_ref')]
+    if not refs: return
+    conn = get_db_connection()
+    now_iso = datetime.datetime.now().isoformat()
+    conn.executemany(
+        """INSERT INTO AttachmentRefs (session_id, chat_title, media_key, message_id, meta_text, kind,
+               target_name, size_bytes, created, updated)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT (session_id, media_key) DO NOTHING""",
+        [(session_id, chat_title, m['attachment_ref']['media_key'], m['attachment_ref'].get('message_id'),
+          m['meta_text'], m['attachment_ref']['kind'], m['attachment_ref']['target_name'],
+          m['attachment_ref'].get('size_bytes'), now_iso, now_iso) for m in refs]
+    )
+    conn.commit()
+    conn.close()
+    print(f"🗂️ Recorded {len(refs)} deferred attachment(s) for '{chat_title}'.")
+
+def record_failed_downloads(session_id, jobs):
+    """
+    Handles downloads that failed after their messages were saved: each becomes a
+    'failed' AttachmentRef (retried through POST /api/attachments/<id>/fetch) and its
+    message stops pointing at a file that was never written.
+    """
+    if not jobs: return
+    conn = get_db_connection()
+    now_iso = datetime.datetime.now().isoformat()
+    for job in jobs:
+        conn.execute(
+            """INSERT INTO AttachmentRefs (session_id, chat_title, media_key, message_id, meta_text, kind,
+                   target_name, status, created, updated)
+               SELECT ?, c.title, ?, ?, m.meta_text, ?, ?, 'failed', ?, ?
+               FROM Messages m JOIN Conversations c ON m.conversation_id = c.id
+               WHERE m.attachment_key = ? LIMIT 1
+               ON CONFLICT (session_id, media_key) DO UPDATE SET status = 'failed', updated = excluded.updated""",
+            (session_id, job['media_key'], job.get('message_id'), job['kind'], job['target_name'], now_iso, now_iso, job['media_key'])
+        )
+        conn.execute("UPDATE Messages SET attachment_filename = NULL WHERE attachment_key = ?", (job['media_key'],))
+    conn.commit()
+    conn.close()
+    print(f"🗂️ Recorded {len(jobs)} failed attachment download(s) for {session_id}.")
+
+def get_attachment_ref(ref_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM AttachmentRefs WHERE id = ?", (ref_id,))
+    ref = cursor.fetchone()
+    conn.close()
+    return dict(ref) if ref else None
+
+def request_attachment_fetch(ref_id):
+    """Marks a deferred (or previously failed) attachment to be fetched on the session's next sync."""
+    conn = get_db_connection()
+    conn.execute(
+        "UPDATE AttachmentRefs SET status = 'requested', updated = ? WHERE id = ? AND status IN ('deferred', 'failed')",
+        (datetime.datetime.now().isoformat(), ref_id)
+    )
+    conn.commit()
+    conn.close()
+    return get_attachment_ref(ref_id)
+
+def get_requested_attachments(session_id, limit=10):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT * FROM AttachmentRefs WHERE session_id = ? AND status = 'requested' ORDER BY updated LIMIT ?",
+        (session_id, limit)
+    )
+    refs = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return refs
+
+def mark_attachment_fetched(ref_id, attachment_filename):
+    """
+    Records a fetched attachment and links the file to its message by media key.
+    Messages stored before deferred attachments kept their key are matched on meta
+    text, but only when that is unambiguous: a sender's messages within the same
+    minute share it.
+    """
+    conn = get_db_connection()
+    now_iso = datetime.datetime.now().isoformat()
+    conn.execute(
+        "UPDATE AttachmentRefs SET status = 'fetched', attachment_filename = ?, updated = ? WHERE id = ?",
+        (attachment_filename, now_iso, ref_id)
+    )
+    ref = conn.execute("SELECT media_key, meta_text FROM AttachmentRefs WHERE id = ?", (ref_id,)).fetchone()
+    linked = conn.execute(
+        "UPDATE Messages SET attachment_filename = ? WHERE attachment_key = ?", (attachment_filename, ref['media_key'])
+    ).rowcount
+    if not linked:
+        conn.execute(
+            """UPDATE Messages SET attachment_filename = ?, attachment_key = ?
+               WHERE meta_text = ? AND attachment_key IS NULL
+                 AND (SELECT COUNT(*) FROM Messages WHERE meta_text = ? AND attachment_key IS NULL) = 1""",
+            (attachment_filename, ref['media_key'], ref['meta_text'], ref['meta_text'])
+        )
+    conn.commit()
+    conn.close()
+
+def mark_attachment_failed(ref_id):
+    conn = get_db_connection()
+    conn.execute(
+        "UPDATE AttachmentRefs SET status = 'failed', updated = ? WHERE id = ?",
+        (datetime.datetime.now().isoformat(), ref_id)
+    )
+    conn.commit()
+    conn.close()
+
+
+# --- Pending Replies ---
+def get_conversations_awaiting_reply(session_id):
+    """
+    Unreplied conversations (last message from the 'user') of one session whose
+    last message has no generated reply yet, with that message's index. A
+    conversation belongs to the sessions that resolved it in ChatIdentities, or
+    whose chat list shows its title.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT c.id as conversation_id, c.title, c.phone_number, last.message_index as last_message_index
+        FROM Conversations c
+        JOIN Messages last ON last.id = (SELECT m.id FROM Messages m WHERE m.conversation_id = c.id ORDER BY m.message_index DESC LIMIT 1)
+        WHERE last.role = 'user'
+          AND NOT EXISTS (SELECT 1 FROM PendingReplies p WHERE p.conversation_id = c.id AND p.reply_to_index = last.message_index)
+          AND (EXISTS (SELECT 1 FROM ChatIdentities ci WHERE ci.session_id = ?
+                       AND (ci.phone_number = c.phone_number OR (c.phone_number IS NULL AND ci.contact_name = c.title)))
+               OR EXISTS (SELECT 1 FROM ChatListSnapshots s WHERE s.session_id = ? AND s.title = c.title))
+    """, (session_id, session_id))
+    conversations = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return conversations
+
+def save_pending_replies(session_id, replies):
+    """Queues generated replies: [(conversation_id, reply_to_index, reply)]."""
+    if not replies: return
+    conn = get_db_connection()
+    now_iso = datetime.datetime.now().isoformat()
+    conn.executemany(
+        """INSERT INTO PendingReplies (session_id, conversation_id, reply_to_index, reply, created, updated)
+           VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (conversation_id, reply_to_index) DO NOTHING""",
+        [(session_id, cid, index, reply, now_iso, now_iso) for cid, index, reply in replies]
+    )
+    conn.commit()
+    conn.close()
+
+def get_pending_replies(session_id):
+    """
+    Replies waiting to be sent by this session. is_current is false when the
+    conversation moved on (new messages) after the reply was generated.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT p.id, p.conversation_id, p.reply, c.title, c.phone_number,
+               p.reply_to_index = (SELECT MAX(m.message_index) FROM Messages m WHERE m.conversation_id = c.id) as is_current
+        FROM PendingReplies p JOIN Conversations c ON c.id = p.conversation_id
+        WHERE p.session_id = ? AND p.status = 'pending' ORDER BY p.id
+    """, (session_id,))
+    replies = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+    return replies
+
+def mark_pending_reply(reply_id, status):
+    """Moves a pending reply to 'sent' or 'stale'."""
+    conn = get_db_connection()
+    conn.execute(
+        "UPDATE PendingReplies SET status = ?, updated = ? WHERE id = ?",
+        (status, datetime.datetime.now().isoformat(), reply_id)
+    )
+    conn.commit()
+    conn.close()
+
+
+# --- Reply Cache ---
+def get_cached_reply(prompt_hash, max_age_seconds):
+    """Returns a cached reply younger than max_age_seconds and marks it used, or None."""
+    conn = get_db_connection()
+    now = datetime.datetime.now()
+    oldest = (now - datetime.timedelta(seconds=max_age_seconds)).isoformat()
+    row = conn.execute("SELECT reply FROM ReplyCache WHERE prompt_hash = ? AND created >= ?", (prompt_hash, oldest)).fetchone()
+    if row:
+        conn.execute("UPDATE ReplyCache SET last_used = ? WHERE prompt_hash = ?", (now.isoformat(), prompt_hash))
+        conn.commit()
+    conn.close()
+    return row["reply"] if row else None
+
+def save_cached_reply(prompt_hash, reply, max_entries, max_age_seconds):
+    """Caches a reply, then drops expired entries and the least recently used beyond max_entries."""
+    conn = get_db_connection()
+    now = datetime.datetime.now()
+    conn.execute(
+        """INSERT INTO ReplyCache (prompt_hash, reply, created, last_used) VALUES (?, ?, ?, ?)
+           ON CONFLICT (prompt_hash) DO UPDATE SET reply = excluded.reply, created = excluded.created, last_used = excluded.last_used""",
+        (prompt_hash, reply, now.isoformat(), now.isoformat())
+    )
+    conn.execute("DELETE FROM ReplyCache WHERE created < ?", ((now - datetime.timedelta(seconds=max_age_seconds)).isoformat(),))
+    conn.execute(
+        "DELETE FROM ReplyCache WHERE prompt_hash IN (SELECT prompt_hash FROM ReplyCache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+        (max_entries,)
+    )
+    conn.commit()
+    conn.close()
+
+
+# --- Content-Addressed Attachments ---
+def save_attachment(content_hash, size_bytes, mime_type, stored_path):
+    conn = get_db_connection()
+    conn.execute(
+        """INSERT INTO Attachments (content_hash, size_bytes, mime_type, stored_path, created)
+           VALUES (?, ?, ?, ?, ?) ON CONFLICT (content_hash) DO NOTHING""",
+        (content_hash, size_bytes, mime_type, stored_path, datetime.datetime.now().isoformat())
+    )
+    conn.commit()
+    conn.close()
+
+def save_attachment_name(media_key, content_hash, original_name):
+    """Points a message's attachment (by media key) at its stored content."""
+    conn = get_db_connection()
+    conn.execute(
+        """INSERT INTO AttachmentNames (media_key, content_hash, original_name, created)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT (media_key) DO UPDATE SET content_hash = excluded.content_hash, original_name = excluded.original_name""",
+        (media_key, content_hash, original_name, datetime.datetime.now().isoformat())
+    )
+    conn.commit()
+    conn.close()
+
+def get_attachment_for_key(media_key):
+    """Returns the stored attachment (hash, size, mime, path, original name) for a media key, or None."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT a.content_hash, a.size_bytes, a.mime_type, a.stored_path, n.original_name
+           FROM AttachmentNames n JOIN Attachments a ON a.content_hash = n.content_hash
+           WHERE n.media_key = ?""",
+        (media_key,)
+    )
+    attachment = cursor.fetchone()
+    conn.close()
+    return dict(attachment) if attachment else None
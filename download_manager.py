@@ -0,0 +1,308 @@
+# download_manager.py
+import os
+import json
+import time
+import base64
+import threading
+import weakref
+import config
+import attachment_store
+from selenium.common.exceptions import WebDriverException
+
+# One tracker and one download queue per live driver; entries disappear with the driver object.
+_trackers = weakref.WeakKeyDictionary()
+_queues = weakref.WeakKeyDictionary()
+_trackers_lock = threading.Lock()
+
+
+def _normalize_name(filename):
+    return (filename or "").strip().strip('"\'').strip().lower()
+
+
+class DownloadTracker:
+    """
+    Follows Chrome's download events for one driver through the DevTools Protocol.
+    Downloads are correlated by their guid, so several can be in flight at once and
+    each waiter gets exactly its own file as soon as Chrome reports it complete.
+    """
+
+    def __init__(self, driver, download_dir):
+        # A proxy keeps the registry's weak key from being pinned by its own value
+        self.driver = weakref.proxy(driver)
+        self.download_dir = download_dir
+        self.named_by_guid = False
+        self.downloads = {}  # guid -> {"suggested", "began", "state", "claimed"}
+        self.tickets = []    # waiters whose download hasn't begun yet, in click order
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """Points Chrome's downloads at download_dir and turns on download events."""
+        os.makedirs(self.download_dir, exist_ok=True)
+        try:
+            # Files are written as <download_dir>/<guid>, which makes correlation exact.
+            self.driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+                "behavior": "allowAndName", "downloadPath": self.download_dir, "eventsEnabled": True
+            })
+            self.named_by_guid = True
+        except WebDriverException:
+            self.driver.execute_cdp_cmd("Page.setDownloadBehavior", {
+                "behavior": "allow", "downloadPath": self.download_dir
+            })
+        # Drain anything logged before tracking started
+        self.driver.get_log("performance")
+
+    def poll(self):
+        """Reads pending download events from the performance log."""
+        for entry in self.driver.get_log("performance"):
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError):
+                continue
+            method = message.get("method", "")
+            params = message.get("params", {})
+            if method.endswith(".downloadWillBegin"):
+                self.downloads.setdefault(params["guid"], {
+                    "suggested": params.get("suggestedFilename"),
+                    "began": entry.get("timestamp", time.time() * 1000) / 1000,
+                    "state": "inProgress",
+                    "claimed": False,
+                })
+            elif method.endswith(".downloadProgress") and params.get("guid") in self.downloads:
+                self.downloads[params["guid"]]["state"] = params.get("state", "inProgress")
+
+    def expect(self, match_name=None):
+        """
+        Registers interest in the next download. Call it right before clicking a
+        download control: downloads are handed to tickets in registration order,
+        preferring the ticket whose match_name equals Chrome's suggested filename.
+        """
+        with self.lock:
+            ticket = {"match_name": _normalize_name(match_name), "registered": time.time(), "guid": None}
+            self.tickets.append(ticket)
+            return ticket
+
+    def _assign(self):
+        """Hands newly begun downloads to waiting tickets. Caller holds the lock."""
+        for guid, info in sorted(self.downloads.items(), key=lambda item: item[1]["began"]):
+            if info["claimed"]: continue
+            open_tickets = [t for t in self.tickets if info["began"] >= t["registered"] - 1]
+            if not open_tickets: continue
+            name = _normalize_name(info["suggested"])
+            ticket = next((t for t in open_tickets if t["match_name"] and t["match_name"] == name), None) \
+                or next((t for t in open_tickets if not t["match_name"]), None) \
+                or open_tickets[0]
+            ticket["guid"] = guid
+            info["claimed"] = True
+            self.tickets.remove(ticket)
+
+    def _refresh(self, ticket):
+        """Returns (guid, state) for a ticket, or (None, None) while its download hasn't begun."""
+        with self.lock:
+            self.poll()
+            self._assign()
+            if ticket["guid"] is None:
+                return None, None
+            return ticket["guid"], self.downloads[ticket["guid"]]["state"]
+
+    def finish(self, guid, target_name=None, media_key=None):
+        """Moves a completed download into the attachment store and returns the name it arrived under."""
+        with self.lock:
+            info = self.downloads.pop(guid)
+        filename = target_name or info["suggested"] or guid
+        path = os.path.join(self.download_dir, guid if self.named_by_guid else (info["suggested"] or guid))
+        attachment_store.store_file(path, filename, media_key)
+        return filename
+
+    def check(self, ticket, target_name=None, media_key=None):
+        """
+        Looks at a ticket's download once, without waiting. Returns its filename once it
+        has completed, False if the browser cancelled it, or None while it is still pending.
+        """
+        guid, state = self._refresh(ticket)
+        if state == "completed":
+            filename = self.finish(guid, target_name, media_key)
+            print(f"   -> 📥 Download complete: {filename}")
+            return filename
+        if state == "canceled":
+            print("   -> ⚠️ Download was cancelled by the browser.")
+            with self.lock:
+                self.downloads.pop(guid, None)
+            return False
+        return None
+
+    def forget(self, ticket):
+        """Drops a ticket that is no longer waited on."""
+        with self.lock:
+            if ticket in self.tickets: self.tickets.remove(ticket)
+
+    def wait_for_download(self, ticket, target_name=None, timeout=45, media_key=None):
+        """
+        Blocks until the ticket's download completes and returns its filename,
+        or None if it never started, was cancelled, or timed out.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            filename = self.check(ticket, target_name, media_key)
+            if filename is not None:
+                return filename or None
+            time.sleep(0.2)
+
+        self.forget(ticket)
+        print("   -> ⚠️ Timeout: Download did not complete in time.")
+        return None
+
+
+# Reads several blob: URLs inside the page in parallel and returns each one's bytes
+# as base64 (null where a fetch failed), in the order given.
+_FETCH_BLOBS_JS = """
+const [urls, done] = arguments;
+const read = url => fetch(url).then(r => r.blob()).then(blob => new Promise(resolve => {
+    const reader = new FileReader();
+    reader.onload = () => resolve(reader.result.split(',')[1]);
+    reader.onerror = () => resolve(null);
+    reader.readAsDataURL(blob);
+})).catch(() => null);
+Promise.all(urls.map(read)).then(done, () => done(urls.map(() => null)));
+"""
+
+
+class MediaDownloadQueue:
+    """
+    Bounded queue of attachment downloads for one driver, worked off between scroll
+    steps so scraping never waits on a file. A job either names a blob: URL to fetch
+    in-page or holds a DownloadTracker ticket for a download Chrome has already started;
+    either way the file ends up in the content-addressed attachment store.
+    WebDriver sessions are not thread-safe, so every call here runs on the thread
+    that drives the browser: pump() does one pass, drain() finishes up once per session.
+    The concurrency lives in the page instead: Chrome runs started downloads side by
+    side, and each pump fetches up to `concurrency` blobs in one parallel script call.
+    """
+
+    def __init__(self, driver, tracker=None, concurrency=3, max_pending=32, timeout=45):
+        self.driver = weakref.proxy(driver)
+        self.tracker = tracker
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = []
+        self.failed = []  # kept until drain() hands them to the caller
+
+    def submit(self, job):
+        """Queues a job; only waits when max_pending jobs are already in flight."""
+        job["deadline"] = time.time() + self.timeout
+        self.pending.append(job)
+        while len(self.pending) >= self.max_pending:
+            time.sleep(0.2)
+            self.pump()
+
+    def pump(self):
+        """Advances every pending job once; only a batch of blob fetches is waited on."""
+        blobs = self._fetch_blobs([job for job in self.pending if job.get("blob_url")][:self.concurrency])
+        still_pending = []
+        for job in self.pending:
+            try:
+                # A blob beyond this pass's batch stays pending (None)
+                filename = blobs.get(id(job)) if job.get("blob_url") else self._step(job)
+            except Exception as e:
+                print(f"   -> ⚠️ Download error for '{job['target_name']}': {e}")
+                filename = False
+            if filename is None and time.time() >= job["deadline"]:
+                if job.get("ticket") and self.tracker: self.tracker.forget(job["ticket"])
+                print(f"   -> ⚠️ Timeout: '{job['target_name']}' did not download in time.")
+                filename = False
+            if filename is None:
+                still_pending.append(job)
+            elif filename is False:
+                self.failed.append(job)
+        self.pending = still_pending
+
+    def _fetch_blobs(self, jobs):
+        """Fetches a batch of blob jobs in one script call. Returns {id(job): filename or False}."""
+        if not jobs:
+            return {}
+        try:
+            results = self.driver.execute_async_script(_FETCH_BLOBS_JS, [job["blob_url"] for job in jobs])
+        except WebDriverException as e:
+            print(f"   -> ⚠️ Blob fetch failed: {e}")
+            results = [None] * len(jobs)
+        filenames = {}
+        for job, data in zip(jobs, results):
+            if not data:
+                print(f"   -> ⚠️ Could not read {job['kind']} '{job['target_name']}' from the page.")
+                filenames[id(job)] = False
+                continue
+            attachment_store.store_bytes(base64.b64decode(data), job["target_name"], job.get("media_key"))
+            print(f"   -> 📥 Saved {job['kind']}: {job['target_name']}")
+            filenames[id(job)] = job["target_name"]
+        return filenames
+
+    def _step(self, job):
+        """Returns a ticket job's filename once stored, False if it failed, or None while pending."""
+        if self.tracker and job.get("ticket"):
+            return self.tracker.check(job["ticket"], target_name=job["target_name"], media_key=job.get("media_key"))
+        return False
+
+    def drain(self, timeout):
+        """Pumps until every job has finished or timeout passes. Returns the failed jobs."""
+        deadline = time.time() + timeout
+        self.pump()
+        while self.pending and time.time() < deadline:
+            time.sleep(0.2)
+            self.pump()
+        if self.pending:
+            print(f"   ⚠️ {len(self.pending)} attachment download(s) did not finish in time.")
+            self.failed += self.pending
+            self.pending = []
+        failed, self.failed = self.failed, []
+        return failed
+
+
+def enable_download_tracking(driver, download_dir):
+    """Starts CDP download tracking for a driver. Returns the tracker, or None if unsupported."""
+    tracker = DownloadTracker(driver, download_dir)
+    try:
+        tracker.enable()
+    except WebDriverException as e:
+        print(f"⚠️ CDP download tracking unavailable, falling back to folder polling: {e}")
+        return None
+    with _trackers_lock:
+        _trackers[driver] = tracker
+    return tracker
+
+
+def get_tracker(driver):
+    with _trackers_lock:
+        return _trackers.get(driver)
+
+
+def get_download_queue(driver):
+    """Returns the driver's download queue, creating it on first use."""
+    with _trackers_lock:
+        download_queue = _queues.get(driver)
+        if download_queue is None:
+            download_queue = MediaDownloadQueue(
+                driver, tracker=_trackers.get(driver), concurrency=config.MEDIA_DOWNLOAD_CONCURRENCY,
+                max_pending=config.MEDIA_DOWNLOAD_QUEUE_SIZE, timeout=config.MEDIA_DOWNLOAD_TIMEOUT_SECONDS
+            )
+            _queues[driver] = download_queue
+        return download_queue
+
+
+def pump_download_queue(driver):
+    """Advances the driver's queued downloads without waiting. Call between scroll steps."""
+    with _trackers_lock:
+        download_queue = _queues.get(driver)
+    if download_queue:
+        download_queue.pump()
+
+
+def drain_download_queue(driver, timeout=None):
+    """
+    Lets a driver's queued downloads finish and returns the jobs that failed.
+    Call on the driver's own thread, once per session and before quitting the driver.
+    """
+    with _trackers_lock:
+        download_queue = _queues.pop(driver, None)
+    if not download_queue:
+        return []
+    return download_queue.drain(config.MEDIA_DOWNLOAD_DRAIN_TIMEOUT_SECONDS if timeout is None else timeout)
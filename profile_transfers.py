@@ -0,0 +1,113 @@
+# profile_transfers.py
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import config
+import bot_state
+import storage_manager
+import browser_pool
+
+
+class ProfileTransfers:
+    """
+    Moves Chrome profiles to and from storage off the sync's critical path.
+    Profiles of sessions due soon are downloaded ahead of time, and finished
+    sessions are uploaded in the background. A session has at most one transfer
+    in flight, and its next sync waits for that transfer before touching the profile.
+    """
+
+    def __init__(self, workers, fresh_seconds):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="profile")
+        self.fresh_seconds = fresh_seconds
+        self.tasks = {}       # session_id -> in-flight future (prefetch or upload)
+        self.prefetched = {}  # session_id -> time its prefetch finished
+        self.lock = threading.RLock()  # done callbacks may run inside _submit
+
+    def prefetch(self, session_ids):
+        """Starts downloading these profiles unless a transfer is in flight or a fresh copy is waiting."""
+        with self.lock:
+            for session_id in session_ids:
+                if session_id in self.tasks or self._fresh(session_id): continue
+                self._submit(session_id, self._prefetch)
+
+    def upload(self, session_id):
+        """Saves a session's profile in the background, after any transfer already queued for it."""
+        with self.lock:
+            self.prefetched.pop(session_id, None)
+            self._submit(session_id, self._upload, self.tasks.get(session_id))
+
+    def wait(self, session_id, timeout=None):
+        """Blocks until the session's in-flight transfer, if any, has finished. False on timeout."""
+        with self.lock:
+            future = self.tasks.get(session_id)
+        if future:
+            return not wait([future], timeout=timeout).not_done
+        return True
+
+    def take_prefetched(self, session_id):
+        """True (once) if the session's profile was prefetched recently and is still on disk."""
+        with self.lock:
+            fresh = self._fresh(session_id)
+            self.prefetched.pop(session_id, None)
+        return bool(fresh) and os.path.exists(os.path.join(storage_manager.PROFILES_DIR, session_id))
+
+    def _fresh(self, session_id):
+        finished = self.prefetched.get(session_id)
+        return finished and time.time() - finished < self.fresh_seconds
+
+    def _submit(self, session_id, task, after=None):
+        future = self.executor.submit(self._run, session_id, task, after)
+        self.tasks[session_id] = future
+        future.add_done_callback(lambda f: self._done(session_id, f))
+
+    def _done(self, session_id, future):
+        with self.lock:
+            if self.tasks.get(session_id) is future:
+                del self.tasks[session_id]
+
+    @staticmethod
+    def _run(session_id, task, after):
+        if after:
+            wait([after])
+        try:
+            task(session_id)
+        except Exception as e:
+            print(f"   ❌ Profile transfer for {session_id} failed: {e}")
+
+    def _prefetch(self, session_id):
+        # A held lock means a login or send is using the profile right now
+        session_lock = bot_state.get_session_lock(session_id)
+        if not session_lock.acquire(blocking=False):
+            return
+        try:
+            if storage_manager.download_session(session_id):
+                with self.lock:
+                    self.prefetched[session_id] = time.time()
+                print(f"   📦 Prefetched profile for {session_id}")
+        finally:
+            session_lock.release()
+
+    @staticmethod
+    def _upload(session_id):
+        # Submitted by the sync that still holds the lock; runs once it lets go. A login
+        # can hold the lock until its QR code is scanned, so don't wait on it forever.
+        session_lock = bot_state.get_session_lock(session_id)
+        if not session_lock.acquire(timeout=config.PROFILE_UPLOAD_LOCK_TIMEOUT_SECONDS):
+            print(f"   ⏭️ {session_id} is still busy. Skipping this upload; the next sync or login saves the profile.")
+            return
+        try:
+            # Chrome rewrites LevelDB/IndexedDB/Cookies while it runs, so a profile
+            # with an open (warm) browser is saved once that browser closes
+            if browser_pool.pool.is_open(session_id):
+                print(f"   ⏸️ Browser for {session_id} is still open. Saving its profile when it closes.")
+                return
+            storage_manager.upload_session(session_id)
+        finally:
+            session_lock.release()
+
+
+transfers = ProfileTransfers(config.PROFILE_TRANSFER_WORKERS, config.PREFETCH_HORIZON_SECONDS)
+browser_pool.pool.on_close = transfers.upload
+storage_manager.evict_browser = browser_pool.pool.evict
+storage_manager.browser_is_open = browser_pool.pool.is_open
@@ -6,9 +6,12 @@ import time
 import re
 import platform
 import random
+import hashlib
+import threading
 import pyperclip
 import config
-from tqdm import tqdm
+import download_manager
+import attachment_store
 from uuid import uuid4
 from bs4 import BeautifulSoup
 from datetime import datetime
@@ -18,11 +21,11 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException,NoSuchWindowException, WebDriverException,ElementClickInterceptedException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException,NoSuchWindowException, WebDriverException,ElementClickInterceptedException, SessionNotCreatedException
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from database_manager import normalize_phone_number
+from database_manager import normalize_phone_number, get_chat_identity, save_chat_identity
 
 import base64
 from io import BytesIO
@@ -41,17 +44,29 @@ def load_selectors(filename="selectors.json"):
         print(f"❌ FATAL ERROR: Could not decode JSON from '{filename}'. Please check its format.")
         sys.exit(1)
 
+def compile_selectors(selectors):
+    """Builds a (By, selector) locator tuple once for every selector key."""
+    return {
+        key: (By.XPATH if value.startswith(('//', './', '(')) else By.CSS_SELECTOR, value)
+        for key, value in selectors.items()
+    }
+
 SELECTORS = load_selectors()
+LOCATORS = compile_selectors(SELECTORS)
 
 def get_element(driver, key, timeout=10, find_all=False, wait_condition=EC.presence_of_element_located, format_args=None, suppress_error=False, context_message=None):
     """Safely finds elements, reporting detailed, contextual errors on failure."""
     try:
-        selector_value = SELECTORS[key]
+        by, selector_value = LOCATORS[key]
         if format_args:
             selector_value = selector_value.format(*format_args)
-        by = By.XPATH if selector_value.startswith(('//', './', '(')) else By.CSS_SELECTOR
-        wait = WebDriverWait(driver, timeout)
         locator = (by, selector_value)
+        if wait_condition is EC.presence_of_element_located:
+            # Fast path: elements that are already present cost a single round trip
+            found = driver.find_elements(*locator)
+            if found:
+                return found if find_all else found[0]
+        wait = WebDriverWait(driver, timeout)
         if find_all:
             wait_condition = EC.presence_of_all_elements_located if wait_condition == EC.presence_of_element_located else wait_condition
             return wait.until(wait_condition(locator))
@@ -71,6 +86,106 @@ def get_element(driver, key, timeout=10, find_all=False, wait_condition=EC.prese
         return [] if find_all else None
 
 
+# Evaluates many locators in one round trip; misses come back as null instead of timeouts.
+_PROBE_JS = """
+const [entries, scope] = arguments;
+const root = scope || document;
+const matches = {};
+for (const [key, by, selector] of entries) {
+    let el = null;
+    try {
+        el = (by === 'xpath')
+            ? document.evaluate(selector, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue
+            : root.querySelector(selector);
+    } catch (e) { el = null; }
+    matches[key] = el;
+}
+return matches;
+"""
+
+def probe(driver, keys, scope=None):
+    """
+    Resolves several selector keys in a single injected script, optionally scoped
+    to an element. Returns {key: WebElement or None} for every requested key.
+    """
+    entries = [[key, *LOCATORS[key]] for key in keys]
+    try:
+        matches = driver.execute_script(_PROBE_JS, entries, scope) or {}
+    except (StaleElementReferenceException, WebDriverException):
+        matches = {}
+    return {key: matches.get(key) for key in keys}
+
+def wait_for_probe(driver, keys, timeout=10, scope=None):
+    """
+    Polls probe() until at least one key matches or the timeout expires, so a
+    branch between alternatives costs one wait instead of one timeout per miss.
+    """
+    result = {key: None for key in keys}
+    def any_matched(d):
+        nonlocal result
+        result = probe(d, keys, scope)
+        return any(result.values())
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.25).until(any_matched)
+    except TimeoutException:
+        pass
+    return result
+
+
+_CHROMEDRIVER_PATH = None
+_CHROMEDRIVER_LOCK = threading.Lock()
+
+def resolve_chromedriver_path(refresh=False):
+    """
+    Resolves the chromedriver binary once and pins it for the life of the process
+    and across restarts (via config.CHROMEDRIVER_CACHE_FILE). Only a missing or
+    refreshed pin triggers webdriver-manager's version check and download.
+    """
+    global _CHROMEDRIVER_PATH
+    with _CHROMEDRIVER_LOCK:
+        if refresh:
+            _CHROMEDRIVER_PATH = None
+        if _CHROMEDRIVER_PATH and os.path.exists(_CHROMEDRIVER_PATH):
+            return _CHROMEDRIVER_PATH
+
+        # 1. Explicit pin from the environment wins
+        if config.CHROMEDRIVER_PATH and os.path.exists(config.CHROMEDRIVER_PATH):
+            _CHROMEDRIVER_PATH = config.CHROMEDRIVER_PATH
+            return _CHROMEDRIVER_PATH
+
+        # 2. Path cached by a previous run
+        if not refresh:
+            try:
+                with open(config.CHROMEDRIVER_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    cached_path = json.load(f).get("path")
+                if cached_path and os.path.exists(cached_path):
+                    _CHROMEDRIVER_PATH = cached_path
+                    return _CHROMEDRIVER_PATH
+            except (FileNotFoundError, json.JSONDecodeError):
+                pass
+
+        # 3. Fall back to webdriver-manager and remember the result
+        print("🌐 Resolving ChromeDriver...")
+        driver_path = ChromeDriverManager().install()
+
+        # Linux Path Fix
+        if platform.system() != "Windows":
+            if "THIRD_PARTY_NOTICES" in driver_path or os.path.isdir(driver_path):
+                parent_dir = os.path.dirname(driver_path) if "THIRD_PARTY_NOTICES" in driver_path else driver_path
+                driver_path = os.path.join(parent_dir, "chromedriver")
+            os.chmod(driver_path, 0o755)
+
+        try:
+            with open(config.CHROMEDRIVER_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump({"path": driver_path}, f)
+        except OSError as e:
+            print(f"⚠️ Could not cache ChromeDriver path: {e}")
+
+        _CHROMEDRIVER_PATH = driver_path
+        print(f"📂 ChromeDriver pinned at: {driver_path}")
+        return _CHROMEDRIVER_PATH
+
+
 # def open_whatsapp():
 #     """
 #     Opens WhatsApp Web with high-precision driver detection to fix WinError 193.
@@ -170,76 +285,198 @@ def ensure_session_dir():
     return session_dir
 
 
+# Runs inside the page: scrolls the virtualized chat list one viewport at a time from
+# startTop and returns the rows it saw once the list ends or budgetMs runs out, so a
+# long list is read in a few bounded round trips instead of one unbounded one.
+_HARVEST_CHAT_LIST_JS = """
+const [paneId, sel, settleMs, startTop, budgetMs, done] = arguments;
+const pane = document.getElementById(paneId);
+if (!pane) { done(null); return; }
+const started = Date.now();
+const rows = new Map();
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+const text = el => (el ? (el.getAttribute('title') || el.textContent || '').trim() : '');
+const chatId = row => {
+    const holder = row.closest('[data-id]') || row.querySelector('[data-id]');
+    // data-ids look like "<jid>" or "false_<jid>_<message id>"
+    return holder ? (holder.getAttribute('data-id').split('_').find(part => part.includes('@')) || null) : null;
+};
+const collect = () => {
+    const seen = [...pane.querySelectorAll(sel.row)]
+        .sort((a, b) => a.getBoundingClientRect().top - b.getBoundingClientRect().top);
+    for (const row of seen) {
+        const titleEl = row.querySelector(sel.title);
+        if (!titleEl) continue;
+        const previews = [...row.querySelectorAll(sel.preview)].filter(el => el !== titleEl);
+        const badge = row.querySelector(sel.unread);
+        const count = badge ? parseInt((badge.textContent || '').replace(/\\D/g, ''), 10) : 0;
+        const entry = {
+            title: text(titleEl),
+            chat_id: chatId(row),
+            preview: previews.length ? text(previews[previews.length - 1]) : '',
+            timestamp: text(row.querySelector(sel.timestamp)),
+            unread: badge ? (count || 1) : 0
+        };
+        // Rows are recycled and shift as the list re-renders; the chat itself is the key
+        rows.set(entry.chat_id || entry.title, entry);
+    }
+};
+(async () => {
+    pane.scrollTop = startTop;
+    await sleep(settleMs);
+    let stalled = 0;
+    while (stalled < 3 && Date.now() - started < budgetMs) {
+        collect();
+        const before = pane.scrollTop;
+        pane.scrollTop = before + pane.clientHeight;
+        await sleep(settleMs);
+        stalled = (pane.scrollTop === before) ? stalled + 1 : 0;
+    }
+    collect();
+    const finished = stalled >= 3;
+    const next = pane.scrollTop;
+    if (finished) pane.scrollTop = 0;
+    done({rows: [...rows.values()], next: next, done: finished});
+})().catch(() => done(null));
+"""
+
+
+def harvest_chat_list(driver, settle_ms=120, budget_ms=10000, max_calls=30):
+    """
+    Scrolls the chat list inside the browser and returns one dict per row
+    (title, chat_id, preview, timestamp, unread) in list order. Each script call
+    stops after budget_ms and the next resumes where it left off; if a call fails,
+    the rows read so far are returned.
+    """
+    row_selectors = {
+        "row": SELECTORS["chat_list_row"],
+        "title": SELECTORS["chat_row_title"],
+        "preview": SELECTORS["chat_row_preview"],
+        "timestamp": SELECTORS["chat_row_timestamp"],
+        "unread": SELECTORS["chat_row_unread_badge"],
+    }
+    rows = {}
+    start_top = 0
+    for _ in range(max_calls):
+        try:
+            step = driver.execute_async_script(_HARVEST_CHAT_LIST_JS, SELECTORS["chat_list_pane_id"], row_selectors, settle_ms, start_top, budget_ms)
+        except (NoSuchWindowException, WebDriverException) as e:
+            print(f"❌ Chat list harvest failed ({type(e).__name__}).")
+            break
+        if step is None:
+            print("❌ Could not find chat list pane or browser window closed.")
+            break
+        for row in step["rows"]:
+            rows[row["chat_id"] or row["title"]] = row
+        if step["done"]:
+            break
+        start_top = step["next"]
+    else:
+        print(f"⚠️ Chat list still not fully read after {max_calls} passes; using the rows seen so far.")
+
+    rows = list(rows.values())
+    print(f"--- Harvested {len(rows)} chat list rows ---")
+    return rows
+
+
 def get_all_contacts(driver):
     """
-    Scrolls through the chat list and scrapes all contact names, preserving duplicates.
+    Returns every chat title in the chat list, preserving duplicates.
     It is resilient to the browser window closing unexpectedly.
     """
+    return [row["title"] for row in harvest_chat_list(driver) if row.get("title")]
+
+
+# Scrolls the virtualized chat list until the chat's row is rendered and returns
+# {element, by_id} so the click goes through WebDriver. Rows are matched on the
+# stored chat id (the row's data-id) first, which survives renames; the exact
+# title is the fallback.
+_FIND_CHAT_ROW_JS = """
+const [paneId, rowSel, titleSel, title, chatId, settleMs, done] = arguments;
+const pane = document.getElementById(paneId);
+if (!pane) { done(null); return; }
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+const hasId = row => {
+    const holder = row.closest('[data-id]') || row.querySelector('[data-id]');
+    // data-ids look like "<jid>" or "false_<jid>_<message id>"
+    return holder && holder.getAttribute('data-id').split('_').includes(chatId);
+};
+const find = () => {
+    const rows = [...pane.querySelectorAll(rowSel)];
+    const byId = chatId && rows.find(hasId);
+    if (byId) return {element: byId.querySelector(titleSel) || byId, by_id: true};
+    const byTitle = rows.map(row => row.querySelector(titleSel))
+        .find(el => el && el.getAttribute('title') === title);
+    return byTitle ? {element: byTitle, by_id: false} : null;
+};
+(async () => {
+    pane.scrollTop = 0;
+    await sleep(settleMs);
+    let stalled = 0;
+    while (stalled < 3) {
+        const hit = find();
+        if (hit) { hit.element.scrollIntoView({block: 'center'}); done(hit); return; }
+        const before = pane.scrollTop;
+        pane.scrollTop = before + pane.clientHeight;
+        await sleep(settleMs);
+        stalled = (pane.scrollTop === before) ? stalled + 1 : 0;
+    }
+    done(null);
+})().catch(() => done(null));
+"""
+
+
+def _open_chat_from_identity(driver, contact_name, identity, session_id):
+    """
+    Opens a chat whose identity is already cached by clicking its chat-list row,
+    skipping the search box and the contact-info panel. The row is found by the
+    cached chat id when there is one, otherwise by title. Returns (None, None) if the
+    row could not be found or, for a title match, the opened header does not match.
+    A chat found by id under a new name gets its cached title and name updated.
+    """
     try:
-        chat_list = driver.find_element(By.ID, SELECTORS["chat_list_pane_id"])
-    except (NoSuchElementException, NoSuchWindowException):
-        print("❌ Could not find chat list pane or browser window closed.")
-        return []
+        hit = driver.execute_async_script(
+            _FIND_CHAT_ROW_JS, SELECTORS["chat_list_pane_id"], SELECTORS["chat_list_row"],
+            SELECTORS["chat_row_title"], contact_name, identity.get("chat_id"), 120
+        )
+        if not hit: return None, None
+        hit["element"].click()
+    except WebDriverException as e:
+        print(f"⚠️ Direct open failed for '{contact_name}' ({type(e).__name__}).")
+        return None, None
 
-    contacts_list = []
-    seen_element_ids = set() # Use a set to track processed Selenium element IDs
+    header = get_element(driver, "chat_header_name", timeout=5, suppress_error=True)
+    if not header or (not hit["by_id"] and header.text.strip() != contact_name):
+        return None, None
 
-    last_height = -1
-    consecutive_no_change = 0
+    name = identity["contact_name"]
+    if hit["by_id"] and identity["title"] != contact_name:
+        # Renamed since it was cached: the header shows the current name
+        name = header.text.strip() or contact_name
+        print(f"    ↳ '{identity['title']}' is now '{contact_name}'. Updating its cached identity.")
+        save_chat_identity(session_id, contact_name, name, identity["phone_number"], identity["chat_id"])
+    print(f"    ↳ Cached identity: Name='{name}', Number='{identity['phone_number'] or 'None'}'")
+    return name, identity["phone_number"]
 
-    print("--- Starting contact scraping ---")
-    while consecutive_no_change < 4: # Increased for more tolerance on slow loads
-        try:
-            # Find all potential contact elements in the current view
-            contact_elements = get_element(driver, "chat_list_titles", timeout=3, find_all=True)
-            
-            new_contacts_found_this_scroll = 0
-            for el in contact_elements:
-                element_id = el.id
-                # If we haven't processed this specific element yet...
-                if element_id not in seen_element_ids:
-                    name = el.get_attribute("title")
-                    if name:
-                        contacts_list.append(name.strip())
-                        new_contacts_found_this_scroll += 1
-                    # Mark this element as seen, whether it had a name or not
-                    seen_element_ids.add(element_id)
-
-            if new_contacts_found_this_scroll > 0:
-                 print(f"   ...found {new_contacts_found_this_scroll} new contacts. Total collected: {len(contacts_list)}")
-
-            # --- Resilient Scrolling ---
-            # Get current scroll position and max scroll height before scrolling
-            current_scroll = driver.execute_script("return arguments[0].scrollTop", chat_list)
-            max_scroll = driver.execute_script("return arguments[0].scrollHeight", chat_list)
-
-            # Scroll down
-            driver.execute_script("arguments[0].scrollTop += 500;", chat_list)
-            time.sleep(1.5)
-
-            new_height = driver.execute_script("return arguments[0].scrollTop", chat_list)
-
-            # Check if we are at the bottom or if the scroll didn't work
-            if new_height == last_height or new_height + driver.execute_script("return arguments[0].offsetHeight", chat_list) >= max_scroll:
-                consecutive_no_change += 1
-                print(f"   ...scroll position unchanged. Consecutive count: {consecutive_no_change}")
-            else:
-                consecutive_no_change = 0
-                last_height = new_height
-        
-        except (StaleElementReferenceException, NoSuchWindowException) as e:
-            print(f"⚠️ Browser state changed during scroll ({type(e).__name__}). Ending contact collection.")
-            break # Exit the loop gracefully
-        except Exception as e:
-            print(f"❌ An unexpected error occurred during contact scraping: {e}")
-            break
 
-    print(f"--- Finished contact scraping. Total entries found: {len(contacts_list)} ---")
-    return contacts_list
+_CLIPBOARD_LOCK = threading.Lock()
 
+def open_chat(driver, contact_name, processed_items, retries=3, session_id=None, chat_id=None):
+    """
+    Modified to use clipboard for searching, ensuring emoji compatibility.
+    When a session_id is given and the chat's identity is cached (looked up by the
+    row's chat_id first, then by title), the chat is opened straight from the chat list instead.
+    """
+    if session_id:
+        identity = get_chat_identity(session_id, contact_name, chat_id)
+        if identity:
+            actual_contact_name, phone_number = _open_chat_from_identity(driver, contact_name, identity, session_id)
+            if actual_contact_name:
+                unique_id = phone_number if phone_number else actual_contact_name
+                if unique_id in processed_items: return None, None
+                return actual_contact_name, phone_number
+            print(f"⚠️ Cached identity for '{contact_name}' did not open. Falling back to search.")
 
-def open_chat(driver, contact_name, processed_items, retries=3):
-    """Modified to use clipboard for searching, ensuring emoji compatibility."""
     for attempt in range(retries):
         search_box = get_element(driver, "search_box", context_message="Find main chat search box.")
         if not search_box: return None, None
@@ -251,8 +488,10 @@ def open_chat(driver, contact_name, processed_items, retries=3):
         search_box.send_keys(control_key + "a")
         search_box.send_keys(Keys.BACKSPACE); time.sleep(0.5)
         
-        pyperclip.copy(contact_name) 
-        search_box.send_keys(control_key + "v") 
+        # The clipboard is shared by every browser this process drives
+        with _CLIPBOARD_LOCK:
+            pyperclip.copy(contact_name) 
+            search_box.send_keys(control_key + "v") 
         time.sleep(2)
         
         chat_results = get_element(driver, "search_result_contact_template", find_all=True, format_args=[contact_name], context_message=f"Find '{contact_name}' in search results.")
@@ -269,6 +508,10 @@ def open_chat(driver, contact_name, processed_items, retries=3):
                 print("⚠️ Could not get contact name from header. Skipping search result.")
                 continue
 
+            # Only an unambiguous title can be mapped back to one identity
+            if session_id and len(chat_results) == 1:
+                save_chat_identity(session_id, contact_name, actual_contact_name, phone_number, chat_id)
+
             unique_id = phone_number if phone_number else actual_contact_name
             if unique_id in processed_items: continue
             
@@ -305,21 +548,24 @@ def get_details_from_header(driver):
     actual_contact_name = contact_header.text.strip()
     
     contact_header.click()
-    time.sleep(1.5) 
-    
-    # 1. Primary attempt: Try to find the number using the standard selector.
-    phone_element = get_element(driver, "contact_info_phone_number", timeout=4, suppress_error=True)
 
-    # 2. Fallback: If the primary attempt fails, try the business account selector.
+    # 1. Wait once for whichever part of the contact-info panel renders first.
+    phone_keys = ["contact_info_phone_number", "contact_info_phone_number_business"]
+    found = wait_for_probe(driver, phone_keys + ["contact_info_body_container"], timeout=10)
+    phone_element = found["contact_info_phone_number"] or found["contact_info_phone_number_business"]
+
+    # 2. Fallback: The body is there but no number yet; give it a moment, then scroll for the business number.
     if not phone_element:
-        print(f"   ...standard number not found for '{actual_contact_name}', checking for business account number.")
-        contact_body=get_element(driver,"contact_info_body_container", timeout=10)
+        contact_body = found["contact_info_body_container"]
         if not contact_body:
             print(f"❌ Could not find contact info body for '{actual_contact_name}' maybe a group chat.")
             return actual_contact_name, None
-        driver.execute_script("arguments[0].scrollTop = arguments[0].scrollHeight", contact_body)
-        time.sleep(1)
-        phone_element = get_element(driver, "contact_info_phone_number_business", timeout=3, suppress_error=True)
+        print(f"   ...standard number not found for '{actual_contact_name}', checking for business account number.")
+        found = wait_for_probe(driver, phone_keys, timeout=1.5)
+        phone_element = found["contact_info_phone_number"] or found["contact_info_phone_number_business"]
+        if not phone_element:
+            driver.execute_script("arguments[0].scrollTop = arguments[0].scrollHeight", contact_body)
+            phone_element = wait_for_probe(driver, ["contact_info_phone_number_business"], timeout=3)["contact_info_phone_number_business"]
 
     if phone_element:
         phone_text = phone_element.text.strip()
@@ -354,11 +600,33 @@ def get_details_from_header(driver):
     return final_name, final_number
 
 
-def smart_scroll_and_collect(driver, stop_at_last=None):
+# The data-id of the row holding a message bubble: WhatsApp's stable id for that message.
+_MESSAGE_ID_JS = "const holder = arguments[0].closest('[data-id]'); return holder ? holder.getAttribute('data-id') : null;"
+
+
+# Image and video bubbles stored before attachments were keyed by data-id read
+# "📷 Image (<name Chrome saved the file under>)". That name can't be rebuilt from the
+# bubble, so such a stored watermark is compared only up to where the name starts.
+_LEGACY_MEDIA_WATERMARK = re.compile(r"(\[.*?\] .*?: (?:📷 Image|🎥 Video) \()(?!WhatsApp (?:Image [\w.-]+\.jpg|Video [\w.-]+\.mp4)\)$)")
+
+
+def _reached_watermark(stop_at_last, meta_text):
+    """True if meta_text is the last stored message, stop_at_last."""
+    if not (stop_at_last and meta_text): return False
+    if stop_at_last in meta_text: return True
+    legacy = _LEGACY_MEDIA_WATERMARK.match(stop_at_last)
+    return bool(legacy) and meta_text.startswith(legacy.group(1))
+
+
+def smart_scroll_and_collect(driver, stop_at_last=None, max_incoming=None, incremental=False):
     """
-    Scrolls upward, loads all messages, and stops once the last stored message is found.
-    Handles duplicate attachment cleanup after collection.
+    Scrolls upward, loads all messages, and stops once the last stored message is found
+    or, when max_incoming is given, once that many incoming messages have been read.
+    With incremental=True the chat is read upward from the newest message instead.
     """
+    if incremental:
+        return incremental_scroll_and_collect(driver, stop_at_last=stop_at_last, max_incoming=max_incoming)
+
     chat_container = get_element(driver, "chat_container", timeout=10)
     if not chat_container:
         return []
@@ -369,6 +637,7 @@ def smart_scroll_and_collect(driver, stop_at_last=None):
     found_stop_point = False
     consecutive_no_new = 0
     index = 0
+    incoming_read = 0
 
     while not found_stop_point and consecutive_no_new < 3:
         dismiss_photo_unavailable(driver)  # auto-dismiss popup
@@ -381,26 +650,8 @@ def smart_scroll_and_collect(driver, stop_at_last=None):
                 if not html or html in seen_html:
                     continue
 
-                soup = BeautifulSoup(html, 'html.parser')
-                doc_container = soup.find(
-                    'div', {'role': 'button', 'title': lambda t: t and t.startswith('Download')}
-                )
-
-                # Check for duplicate files before parsing
-                if doc_container:
-                    full_title = doc_container.get('title')
-                    filename = full_title.removeprefix("Download").strip().strip('"').strip("'")
-                    existing_files = [f.lower().strip() for f in os.listdir(config.ATTACHMENTS_DIR)]
-                    if filename.lower() in existing_files:
-                        print(f"⚠️ Skipping duplicate file: {filename}")
-                        seen_html.add(html)
-                        continue
-
-                parsed = parse_message_from_html(driver, html)
-                try:
-                    dismiss_photo_unavailable(driver)  # auto-dismiss popup
-                except Exception:
-                    pass
+                message_id = driver.execute_script(_MESSAGE_ID_JS, element)
+                parsed = parse_message_from_html(driver, html, message_id=message_id)
 
                 if not parsed:
                     seen_html.add(html)
@@ -408,7 +659,7 @@ def smart_scroll_and_collect(driver, stop_at_last=None):
 
                 # --- STOP CONDITION ---
                 meta_text = parsed.get('meta_text')
-                if stop_at_last and meta_text and stop_at_last in meta_text:
+                if _reached_watermark(stop_at_last, meta_text):
                     print("⏹️ Reached previously stored last message during scroll.")
                     found_stop_point = True
                     break
@@ -420,6 +671,13 @@ def smart_scroll_and_collect(driver, stop_at_last=None):
 
                 new_found_this_scroll = True
 
+                if parsed.get('role') == 'user':
+                    incoming_read += 1
+                    if max_incoming and incoming_read >= max_incoming:
+                        print(f"⏹️ Read all {max_incoming} unread message(s).")
+                        found_stop_point = True
+                        break
+
             except StaleElementReferenceException:
                 continue
 
@@ -446,70 +704,154 @@ def smart_scroll_and_collect(driver, stop_at_last=None):
             consecutive_no_new = 0
 
         driver.execute_script("arguments[0].scrollTop = 0;", chat_container)
+        download_manager.pump_download_queue(driver)
         time.sleep(2)
 
-    # --- Clean up duplicate files in attachments folder ---
-    duplicate_pattern = re.compile(r"^(.*)\s\((\d+)\)(\.[^.]+)$")
-    files = os.listdir(config.ATTACHMENTS_DIR)
-    files.sort()
-    for filename in files:
-        match = duplicate_pattern.match(filename)
-        if match:
-            base_name = match.group(1) + match.group(3)
-            full_path = os.path.join(config.ATTACHMENTS_DIR, filename)
-            original_path = os.path.join(config.ATTACHMENTS_DIR, base_name)
-            if os.path.exists(original_path):
-                print(f"🗑️ Removing duplicate: {filename}")
-                os.remove(full_path)
-            else:
-                print(f"↪️ Renaming {filename} → {base_name}")
-                os.rename(full_path, original_path)
-
-    print("✅ Duplicate cleanup complete.")
-
-    # --- Remove duplicates from final_data by attachment filename ---
-    final_data = remove_duplicates_by_filename(final_data)
-
-    # --- Reverse to get oldest-to-newest order ---
-    final_data.reverse()
-    return final_data
+    return _finalize_collected(driver, final_data)
+
+
+# Moves the chat one viewport (to the bottom on the first call, otherwise so the
+# previous top bubble sits at the bottom edge) and returns the bubbles in view.
+_VIEWPORT_STEP_JS = """
+const [container, bubbleSel, toBottom, anchorId, settleMs, done] = arguments;
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+(async () => {
+    const before = container.scrollTop;
+    if (toBottom) {
+        container.scrollTop = container.scrollHeight;
+    } else {
+        const anchor = anchorId && container.querySelector('[data-id="' + CSS.escape(anchorId) + '"]');
+        if (anchor) anchor.scrollIntoView({block: 'end'});
+        else container.scrollTop = Math.max(0, before - container.clientHeight);
+    }
+    await sleep(settleMs);
+    if (container.scrollTop === 0) {
+        // Older history is fetched once the top is reached; give it a moment to land.
+        const height = container.scrollHeight;
+        for (let i = 0; i < 10 && container.scrollHeight === height; i++) await sleep(settleMs / 2);
+    }
+    const view = container.getBoundingClientRect();
+    const bubbles = [...container.querySelectorAll(bubbleSel)]
+        .filter(el => { const r = el.getBoundingClientRect(); return r.bottom >= view.top && r.top <= view.bottom; })
+        .map(el => {
+            const holder = el.closest('[data-id]');
+            const meta = el.querySelector('[data-pre-plain-text]');
+            return {
+                html: el.outerHTML,
+                id: holder ? holder.getAttribute('data-id') : null,
+                meta: meta ? meta.getAttribute('data-pre-plain-text') : null
+            };
+        });
+    done({bubbles: bubbles, moved: container.scrollTop !== before});
+})().catch(() => done(null));
+"""
+
+
+def _iter_bubbles_upward(driver, chat_container, settle_ms=300):
+    """
+    Yields each rendered message bubble once, newest first, starting at the bottom
+    of the chat and walking up one viewport per script call. The caller stops the
+    walk simply by breaking out of the loop.
+    """
+    seen = set()
+    anchor_id = None
+    to_bottom = True
+    stalled = 0
+
+    while stalled < 3:
+        download_manager.pump_download_queue(driver)
+        step = driver.execute_async_script(_VIEWPORT_STEP_JS, chat_container, SELECTORS["all_messages"], to_bottom, anchor_id, settle_ms)
+        to_bottom = False
+        if not step:
+            return
 
+        # Keyed on data-id: identical texts sent in the same minute render identical HTML
+        fresh = [b for b in reversed(step["bubbles"]) if (b["id"] or b["html"]) not in seen]
+        for bubble in fresh:
+            seen.add(bubble["id"] or bubble["html"])
+            yield bubble
 
-def remove_duplicates_by_filename(final_data):
-    seen_files = set()
-    cleaned_data = []
+        if step["bubbles"]:
+            anchor_id = step["bubbles"][0]["id"] or anchor_id
+        if fresh or step["moved"]:
+            stalled = 0
+            continue
 
-    for entry in final_data:
-        fname = entry.get("attachment_filename")
-        if fname:
-            # Normalize filename by removing copy suffixes like (1), (2)
-            normalized_fname = re.sub(r'\s*\(\d+\)(?=\.\w+$)', '', fname).lower().strip()
-            if normalized_fname in seen_files:
-                continue
-            seen_files.add(normalized_fname)
-        cleaned_data.append(entry)
+        # At the top with nothing new: ask WhatsApp for older history before giving up
+        stalled += 1
+        load_btn = probe(driver, ["load_older_messages_button"])["load_older_messages_button"]
+        if load_btn:
+            print("   🔄 Clicking 'Load older messages' button...")
+            driver.execute_script("arguments[0].click();", load_btn)
+            stalled = 0
+
+
+def incremental_scroll_and_collect(driver, stop_at_last=None, max_incoming=None):
+    """
+    Reads a chat upward from its newest message and stops as soon as the last
+    stored message is seen or max_incoming incoming messages have been read,
+    so the cost follows the number of new messages rather than the chat length.
+    """
+    chat_container = get_element(driver, "chat_container", timeout=10)
+    if not chat_container:
+        return []
+
+    print("   --- Incremental pass: reading upward from the newest message ---")
+    final_data = []
+    incoming_read = 0
+
+    dismiss_photo_unavailable(driver)  # auto-dismiss popup
+    for bubble in _iter_bubbles_upward(driver, chat_container):
+        try:
+            parsed = parse_message_from_html(driver, bubble["html"], message_id=bubble["id"])
+        except StaleElementReferenceException:
+            continue
+        if not parsed:
+            continue
+
+        # --- STOP CONDITIONS ---
+        meta_text = parsed.get('meta_text')
+        if _reached_watermark(stop_at_last, meta_text):
+            print("⏹️ Reached previously stored last message.")
+            break
+
+        final_data.append(parsed)
+        print(f"   ...processing message element {len(final_data)}")
+
+        if parsed.get('role') == 'user':
+            incoming_read += 1
+            if max_incoming and incoming_read >= max_incoming:
+                print(f"⏹️ Read all {max_incoming} unread message(s).")
+                break
+
+    return _finalize_collected(driver, final_data)
 
-    return cleaned_data
+
+def _finalize_collected(driver, final_data):
+    """Returns the collected messages oldest-to-newest."""
+    # Attachments are deduplicated by content in attachment_store, not by name here.
+    # Their downloads keep going; the session drains the queue once all chats are read.
+    download_manager.pump_download_queue(driver)
+    final_data.reverse()
+    return final_data
 
 def dismiss_photo_unavailable(driver):
+    ok_button = probe(driver, ["photo_unavailable_ok_button"])["photo_unavailable_ok_button"]
+    if not ok_button:
+        return False
     try:
-        # The popup container
-        popup = driver.find_element('xpath', '//div[@aria-label="Photo unavailable Can\'t view this photo because it\'s no longer on your phone."]')
-        if popup:
-            # Find the OK button inside the popup
-            ok_button = popup.find_element('xpath', './/span[text()="OK"]')
-            ok_button.click()
-            print("🗑️ Dismissed 'Photo unavailable' popup.")
-            time.sleep(1)  # small delay for UI update
-            return True
-    except (NoSuchElementException, ElementClickInterceptedException):
+        ok_button.click()
+        print("🗑️ Dismissed 'Photo unavailable' popup.")
+        time.sleep(1)  # small delay for UI update
+        return True
+    except (StaleElementReferenceException, ElementClickInterceptedException):
         return False
-    return False
 
-def parse_message_from_html(driver, html_snippet):
+def parse_message_from_html(driver, html_snippet, message_id=None):
     """
     Parses a static HTML snippet using a hybrid re-find strategy and now
     gracefully handles special message types like "deleted message".
+    Attachments are handed to the driver's download queue, never waited on.
     """
     soup = BeautifulSoup(html_snippet, 'html.parser')
     message_container = soup.find('div', class_=lambda c: c and 'message-' in c)
@@ -546,35 +888,44 @@ def parse_message_from_html(driver, html_snippet):
     
     content = None
     attachment_filename = None
+    attachment_ref = None
 
     # --- Stage 2: Identify and Process by Message Type ---
     
     doc_container = soup.find('div', {'role': 'button', 'title': lambda t: t and t.startswith('Download')})
     image_container = soup.find('div', {'role': 'button', 'aria-label': 'Open picture'})
     video_container = soup.select_one("div:has(div span[data-icon='media-play'])")
-
+    media_kind = "image" if image_container else "video" if video_container else None
+    media_key = _media_key(message_id, html_snippet) if doc_container or media_kind else None
+    media_ref = media_kind and _attachment_ref(media_kind, soup, media_key, _media_target_name(media_kind, media_key), message_id)
+    already_stored = bool(doc_container or media_kind) and attachment_store.is_stored(media_key)
 
     if doc_container:
         full_title = doc_container.get('title')
         filename = full_title.removeprefix("Download").strip()
         print(f"   - Found document attachment: {filename}")
         
-        
-        
-        try:    
-            element_to_click_xpaths = f"//div[@role='button' and contains(@title, 'Download {filename}')]"
-            element_to_click_xpath = driver.find_element(By.XPATH, element_to_click_xpaths)
-            driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element_to_click_xpath)
-            time.sleep(0.5)
-            download_start_time = time.time()
-            driver.execute_script("arguments[0].click();", element_to_click_xpath)
-            attachment_filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, download_start_time)
-            if attachment_filename: 
-                content = f"📎 Document: {attachment_filename}"
-            else:
-                content = f"📎 Document: download failed"
-        except Exception as e:
-            print(f"  - Warning (Doc Download): Could not click element for {attachment_filename}. Reason: {e}")
+        attachment_ref = _attachment_ref("document", soup, media_key, filename.strip('"\''), message_id)
+        if attachment_ref:
+            content = f"📎 Document: {attachment_ref['target_name']}"
+        elif already_stored:
+            attachment_filename = filename.strip('"\'')
+            content = f"📎 Document: {attachment_filename}"
+        else:
+            try:    
+                element_to_click_xpaths = f"//div[@role='button' and contains(@title, 'Download {filename}')]"
+                element_to_click_xpath = driver.find_element(By.XPATH, element_to_click_xpaths)
+                driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", element_to_click_xpath)
+                time.sleep(0.5)
+                download_handle = _begin_download(driver, match_name=filename)
+                driver.execute_script("arguments[0].click();", element_to_click_xpath)
+                attachment_filename = _queue_download(driver, download_handle, "document", filename.strip('"\''), media_key, message_id)
+                if attachment_filename: 
+                    content = f"📎 Document: {attachment_filename}"
+                else:
+                    content = f"📎 Document: download failed"
+            except Exception as e:
+                print(f"  - Warning (Doc Download): Could not click element for {attachment_filename}. Reason: {e}")
 
         # if attachment_filename:
         #     expected_filename = attachment_filename
@@ -601,6 +952,21 @@ def parse_message_from_html(driver, html_snippet):
     elif soup.find('a', href=lambda h: h and 'maps.google.com' in h):
         content = f"📍 Location: {soup.find('a')['href']}"
 
+    elif media_ref:
+        # Left for an on-demand fetch; only the reference is stored
+        attachment_ref = media_ref
+        content = f"{'📷 Image' if image_container else '🎥 Video'} ({attachment_ref['target_name']})"
+
+    elif media_kind and already_stored:
+        attachment_filename = _media_target_name(media_kind, media_key)
+        content = f"{'📷 Image' if image_container else '🎥 Video'} ({attachment_filename})"
+
+    elif image_container and soup.find('img', src=lambda src: src and src.startswith('blob:')):
+        # Already decrypted in the page: fetch the blob in the background, no viewer needed
+        blob_url = soup.find('img', src=lambda src: src and src.startswith('blob:'))['src']
+        attachment_filename = _queue_blob_download(driver, "image", blob_url, _media_target_name("image", media_key), media_key, message_id)
+        content = f"📷 Image ({attachment_filename})"
+
     elif image_container:
         media_type = "📷 Image"
         try:
@@ -619,9 +985,9 @@ def parse_message_from_html(driver, html_snippet):
                 viewer_opened = True
                 download_button = get_element(driver, "media_viewer_download_button", timeout=5)
                 if download_button:
-                    download_start_time = time.time()
+                    download_handle = _begin_download(driver)
                     driver.execute_script("arguments[0].click();", download_button)
-                    attachment_filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, download_start_time)
+                    attachment_filename = _queue_download(driver, download_handle, "image", _media_target_name("image", media_key), media_key, message_id)
                 content = f"{media_type} ({attachment_filename or 'download failed'})"
             finally:
                 if viewer_opened:
@@ -644,9 +1010,9 @@ def parse_message_from_html(driver, html_snippet):
             viewer_opened = True
             download_button = get_element(driver, "media_viewer_download_button", timeout=5)
             if download_button:
-                download_start_time = time.time()
+                download_handle = _begin_download(driver)
                 driver.execute_script("arguments[0].click();", download_button)
-                attachment_filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, download_start_time)
+                attachment_filename = _queue_download(driver, download_handle, "video", _media_target_name("video", media_key), media_key, message_id)
             content = f"{media_type} ({attachment_filename or 'download failed'})"
         finally:
             if viewer_opened:
@@ -669,7 +1035,93 @@ def parse_message_from_html(driver, html_snippet):
     except Exception:
         pass
 
-    return {"date": date_str, "time": time_str, "sender": sender, "content": content, "meta_text": unique_meta_text, "role": role, "attachment_filename": attachment_filename}
+    message = {"date": date_str, "time": time_str, "sender": sender, "content": content, "meta_text": unique_meta_text, "role": role, "attachment_filename": attachment_filename}
+    # Deferred attachments keep their key too, so a later fetch finds exactly this message
+    if attachment_filename or attachment_ref:
+        message["attachment_key"] = media_key
+    if attachment_ref:
+        message["attachment_ref"] = attachment_ref
+    return message
+
+
+_SIZE_PATTERN = re.compile(r'(\d+(?:[.,]\d+)?)\s*(bytes|B|kB|KB|MB|GB)\b')
+_SIZE_UNITS = {"b": 1, "bytes": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3}
+
+def _parse_size_bytes(text):
+    """Reads a size like '12 MB' or '850 kB' from a bubble's text, or None if there is none."""
+    match = _SIZE_PATTERN.search(text or "")
+    if not match: return None
+    return int(float(match.group(1).replace(',', '.')) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def _attachment_ref(kind, soup, media_key, target_name, message_id=None):
+    """
+    Applies the eager-download policy from config. Returns None when the attachment
+    should be downloaded now, otherwise the reference to store instead of the file.
+    """
+    size_bytes = _parse_size_bytes(soup.get_text(" "))
+    if kind in config.ATTACHMENT_EAGER_TYPES and (size_bytes is None or size_bytes <= config.ATTACHMENT_EAGER_MAX_BYTES):
+        return None
+    return {"kind": kind, "media_key": media_key, "message_id": message_id, "target_name": target_name, "size_bytes": size_bytes}
+
+
+def _begin_download(driver, match_name=None):
+    """
+    Call right before clicking a download control. Returns the handle that
+    _wait_for_download/_queue_download use to find that exact download: a CDP
+    tracker ticket when tracking is enabled, otherwise the click time.
+    """
+    tracker = download_manager.get_tracker(driver)
+    return tracker.expect(match_name) if tracker else time.time()
+
+
+def _wait_for_download(driver, handle, target_name=None, media_key=None):
+    """
+    Waits for the download behind handle, moves it into the attachment store and returns
+    its filename. Uses CDP download events when tracking is enabled for this driver,
+    otherwise polls the attachments folder.
+    """
+    tracker = download_manager.get_tracker(driver)
+    if tracker and isinstance(handle, dict):
+        return tracker.wait_for_download(handle, target_name=target_name, media_key=media_key)
+    filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, handle)
+    if not filename:
+        return None
+    attachment_store.store_file(os.path.join(config.ATTACHMENTS_DIR, filename), target_name or filename, media_key)
+    return target_name or filename
+
+
+def _queue_download(driver, handle, kind, target_name, media_key=None, message_id=None):
+    """
+    Hands a download Chrome has already started to the driver's download queue and returns
+    the name it will be saved under. Without CDP tracking it falls back to waiting inline.
+    """
+    if not isinstance(handle, dict):
+        return _wait_for_download(driver, handle, target_name, media_key)
+    download_manager.get_download_queue(driver).submit({"kind": kind, "ticket": handle, "target_name": target_name, "media_key": media_key, "message_id": message_id})
+    return target_name
+
+
+def _queue_blob_download(driver, kind, blob_url, target_name, media_key=None, message_id=None):
+    """Queues an in-page fetch of a blob: URL and returns the name it will be saved under."""
+    download_manager.get_download_queue(driver).submit({"kind": kind, "blob_url": blob_url, "target_name": target_name, "media_key": media_key, "message_id": message_id})
+    return target_name
+
+
+def _media_key(message_id, html_snippet):
+    """
+    A filesystem-safe key for a message's attachment, taken from its data-id. Every
+    collector passes the data-id; hashing the bubble's HTML is a last resort because
+    the HTML changes with delivery ticks and reactions, so that key is not stable.
+    """
+    if message_id:
+        return re.sub(r'[^\w.-]', '_', message_id)
+    print("   - Warning: Message has no data-id; keying its attachment by its current HTML.")
+    return hashlib.blake2b(html_snippet.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _media_target_name(kind, media_key):
+    return f"WhatsApp Video {media_key}.mp4" if kind == "video" else f"WhatsApp Image {media_key}.jpg"
 
 
 def _wait_for_newest_file(download_dir, download_start_time, timeout=45):
@@ -695,7 +1147,9 @@ def _wait_for_newest_file(download_dir, download_start_time, timeout=45):
 
     # --- Part 2: Find the most recent file created after the download was initiated ---
     try:
+        # The attachment store keeps its blobs in a subfolder here; only files can be downloads
         files = [os.path.join(download_dir, f) for f in os.listdir(download_dir)]
+        files = [f for f in files if os.path.isfile(f)]
         
         # Filter files created *after* the download button was clicked
         new_files = [f for f in files if os.path.getmtime(f) > download_start_time]
@@ -1014,15 +1468,15 @@ def find_element_if_exists(parent_element: WebElement, by: By, value: str):
         return None
     
 
-def _handle_document_download(driver, doc_container: WebElement, downloaded_files_set: set):
+def _handle_document_download(driver, doc_container: WebElement, media_key=None, message_id=None):
     """
-    Workflow for downloading a document. It checks against the provided set of 
-    downloaded files before initiating a click to prevent duplicates.
+    Workflow for downloading a document. It checks the attachment store for this
+    message's file before initiating a click to prevent duplicates.
     
     Args:
         driver: The Selenium WebDriver instance.
         doc_container: The specific WebElement for the document's clickable area.
-        downloaded_files_set: A set of filenames already logged in the database.
+        media_key: The message's attachment key in the attachment store.
         
     Returns:
         A tuple of (content_string, attachment_filename).
@@ -1035,23 +1489,20 @@ def _handle_document_download(driver, doc_container: WebElement, downloaded_file
         expected_filename = full_title.removeprefix("Download").strip()
 
         # --- CHECK IF ALREADY DOWNLOADED ---
-        if expected_filename in downloaded_files_set:
-            print(f"   -> Skipping download: Document '{expected_filename}' already in DB.")
-            return f"📎 Document: {expected_filename}", expected_filename
+        stored = attachment_store.lookup(media_key)
+        if stored:
+            print(f"   -> Skipping download: Document '{stored['original_name']}' already stored.")
+            return f"📎 Document: {stored['original_name']}", stored['original_name']
 
         # --- PROCEED WITH DOWNLOAD ---
         print(f"   - Found new document: '{expected_filename}'. Initiating download...")
         
-        # Record time just before the click
-        download_start_time = time.time()
+        # Register just before the click, then let the download queue finish it
+        download_handle = _begin_download(driver, match_name=expected_filename)
         driver.execute_script("arguments[0].click();", doc_container)
-        
-        # Wait for the file to appear in the downloads folder
-        actual_filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, download_start_time)
+        actual_filename = _queue_download(driver, download_handle, "document", expected_filename.strip('"\''), media_key, message_id)
         
         if actual_filename:
-            # Add to the set for the current session to avoid re-downloading if encountered again
-            downloaded_files_set.add(actual_filename)
             return f"📎 Document: {actual_filename}", actual_filename
         else:
             return "📎 Document: download failed", None
@@ -1061,12 +1512,17 @@ def _handle_document_download(driver, doc_container: WebElement, downloaded_file
         return "📎 Document (Error during download action)", None
     
 
-def _handle_media_viewer_download(driver, media_container: WebElement, media_type: str, downloaded_files_set: set):
+def _handle_media_viewer_download(driver, media_container: WebElement, media_type: str, media_key=None, message_id=None):
     """
     Robust workflow for downloading images/videos via the media viewer.
-    It opens the viewer, attempts to find a specific filename to check against the DB,
-    downloads the file, and reliably closes the viewer.
+    Skips messages whose file is already in the attachment store, otherwise opens the
+    viewer, starts the download, and reliably closes the viewer without waiting for the file.
     """
+    stored = attachment_store.lookup(media_key)
+    if stored:
+        print(f"   -> Skipping download: Media '{stored['original_name']}' already stored.")
+        return f"{media_type} ({stored['original_name']})", stored['original_name']
+
     # Define selectors for elements inside the media viewer for clarity
     viewer_panel_selector = (By.CSS_SELECTOR, "div[data-testid='media-viewer']")
     download_button_selector = (By.CSS_SELECTOR, "span[data-icon='download']")
@@ -1089,24 +1545,18 @@ def _handle_media_viewer_download(driver, media_container: WebElement, media_typ
             # Use a shorter timeout here as the filename is not always present
             filename_element = WebDriverWait(driver, 3).until(EC.visibility_of_element_located(filename_selector))
             expected_filename = filename_element.text
-            
-            # --- CHECK IF ALREADY DOWNLOADED (if we found a name) ---
-            if expected_filename and expected_filename in downloaded_files_set:
-                print(f"   -> Skipping download: Media '{expected_filename}' already in DB.")
-                return f"{media_type} ({expected_filename})", expected_filename
         except Exception:
             # This is common for images that are just pasted into chat
             print("   - Info: No specific filename found in media viewer. Proceeding with download.")
 
         # 3. Download the file
         download_button = wait.until(EC.element_to_be_clickable(download_button_selector))
-        download_start_time = time.time()
+        download_handle = _begin_download(driver, match_name=expected_filename)
         driver.execute_script("arguments[0].click();", download_button)
         
-        actual_filename = _wait_for_newest_file(config.ATTACHMENTS_DIR, download_start_time)
-        
-        if actual_filename:
-            downloaded_files_set.add(actual_filename) # Add to session set
+        kind = "video" if "Video" in media_type else "image"
+        target_name = expected_filename or _media_target_name(kind, media_key or uuid4().hex[:16])
+        actual_filename = _queue_download(driver, download_handle, kind, target_name, media_key, message_id)
         
         return f"{media_type} ({actual_filename or 'download failed'})", actual_filename
 
@@ -1127,142 +1577,73 @@ def _handle_media_viewer_download(driver, media_container: WebElement, media_typ
                 print("  - WARNING: Could not auto-close media viewer. The script might be stuck. A page refresh might be needed if errors persist.")
 
 
-# (Keep your helper functions: get_element, _wait_for_newest_file, etc.)
+_MEDIA_CONTAINER_KEYS = ["message_document_container", "message_image_container", "message_video_container"]
 
-# In whatsappSynchronizer.py (or wherever this function lives)
 
-def collect_message_identifiers(driver, stop_at_last_meta_text=None):
-    """
-    PASS 1: Scrolls to the top of the chat, collecting unique message identifiers
-    until it either reaches the top or finds the 'stop_at_last_meta_text'.
-    """
-    print("   --- Pass 1: Scrolling to collect all message identifiers ---")
-    chat_container = get_element(driver, "chat_container", timeout=10)
-    if not chat_container: return []
+def _parse_bubble_metadata(soup):
+    """Returns (time_str, date_str, sender, role) from a bubble's meta text, or None."""
+    meta_div = soup.find('div', {'data-pre-plain-text': True})
+    if not meta_div: return None
     
-    all_meta_texts = set()
-    stop_point_reached = False
-    consecutive_no_new_scrolls = 0
-
-    while not stop_point_reached and consecutive_no_new_scrolls < 4: # Increased patience
-        # Find all divs that contain a message's unique identifier
-        meta_elements = driver.find_elements(By.XPATH, "//div[@data-pre-plain-text]")
-        
-        if not meta_elements:
-            consecutive_no_new_scrolls += 1
-            time.sleep(1)
-            continue
-
-        new_identifiers_found_this_scroll = False
-        # Process from bottom-up of the current view
-        for element in reversed(meta_elements):
-            try:
-                meta_text = element.get_attribute('data-pre-plain-text')
-                
-                # --- CORRECTED LOGIC ---
-                # Check for the stop point first. If we find it, we stop the entire process.
-                if stop_at_last_meta_text and stop_at_last_meta_text == meta_text:
-                    print("⏹️ Reached previously stored last message. Stopping collection.")
-                    stop_point_reached = True
-                    break # Break the inner for-loop
-
-                # If it's not the stop point, check if it's new and add it.
-                if meta_text not in all_meta_texts:
-                    new_identifiers_found_this_scroll = True
-                    all_meta_texts.add(meta_text)
-
-            except StaleElementReferenceException:
-                continue
-        
-        # If the inner loop was broken by finding the stop point, break the outer loop too.
-        if stop_point_reached:
-            break
-
-        # If we didn't find any new identifiers on this screen, increment counter.
-        if not new_identifiers_found_this_scroll:
-            consecutive_no_new_scrolls += 1
-            print(f"   - No new messages on this scroll ({consecutive_no_new_scrolls}/4).")
-        else:
-            consecutive_no_new_scrolls = 0 # Reset if we find new messages
-            
-        # Scroll to the top to load older messages
-        driver.execute_script("arguments[0].scrollTop = 0;", chat_container)
-        time.sleep(2.5) # Wait for older messages to lazy-load
-
-    # Sort the collected identifiers to ensure they are processed chronologically
-    sorted_identifiers = sorted(list(all_meta_texts))
-    print(f"   -> Collected {len(sorted_identifiers)} new message identifiers.")
-    return sorted_identifiers
-
-
-def process_messages_by_identifier(driver, identifiers, downloaded_files_set):
-    """
-    PASS 2: Iterates through a list of unique message identifiers, finds each live
-    element, and passes it to the processing function for interaction and downloading.
-    """
-    print(f"\n   --- Pass 2: Processing {len(identifiers)} messages for content and downloads ---")
-    final_data = []
-    if not identifiers: return []
+    meta_text_raw = meta_div['data-pre-plain-text']
+    match = re.match(r"\[(.*?), (.*?)\] (.*?):", meta_text_raw)
+    if not match: return None
+    
+    time_str, date_str, sender = [s.strip() for s in match.groups()]
+    role = 'me' if sender == "You" or (sender and config.YOUR_WHATSAPP_NAME in sender) else 'user'
+    if sender == "You": sender = config.YOUR_WHATSAPP_NAME
+    return time_str, date_str, sender, role
 
-    for meta_text in tqdm(identifiers, desc="   Parsing messages", unit="msg"):
-        try:
-            # This XPath is precise: it finds the exact message we want to process
-            xpath = f"//div[@data-pre-plain-text=\"{meta_text}\"]/ancestor::div[contains(@class, 'message-')][1]"
-            message_element = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, xpath))
-            )
-            
-            # Scroll the specific element into view just before processing
-            driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'nearest'});", message_element)
-            time.sleep(0.5)
 
-            # Pass the LIVE WebElement and the set of downloaded files to the processor
-            parsed_data = process_live_message_element(driver, message_element, downloaded_files_set)
-            
-            if parsed_data:
-                final_data.append(parsed_data)
-        except Exception as e:
-            print(f"\n  - Error processing message with meta '{meta_text[:30]}...': {e}")
-            continue
-            
-    return final_data
+def _build_message(time_str, date_str, sender, role, content, attachment_filename=None, attachment_ref=None, attachment_key=None):
+    unique_meta_text = f"[{time_str}, {date_str}] {sender}: {content}"
+    message = {"date": date_str, "time": time_str, "sender": sender, "content": content, "meta_text": unique_meta_text, "role": role, "attachment_filename": attachment_filename}
+    if (attachment_filename or attachment_ref) and attachment_key:
+        message["attachment_key"] = attachment_key
+    if attachment_ref:
+        message["attachment_ref"] = attachment_ref
+    return message
 
 
-def process_live_message_element(driver, message_element: WebElement, downloaded_files_set: set):
+def process_live_message_element(driver, message_element: WebElement, message_id=None, force_download=False):
     """
     Parses a LIVE Selenium WebElement. All find operations are scoped within this element,
-    making them stable and accurate.
+    making them stable and accurate. force_download skips the eager-download policy.
     """
-    # ... (Keep your metadata extraction from the old function, but get HTML from the live element)
     html_snippet = message_element.get_attribute('innerHTML')
     soup = BeautifulSoup(html_snippet, 'html.parser')
     
-    meta_div = soup.find('div', {'data-pre-plain-text': True})
-    if not meta_div: return None
-    
-    meta_text_raw = meta_div['data-pre-plain-text']
-    match = re.match(r"\[(.*?), (.*?)\] (.*?):", meta_text_raw)
-    if not match: return None
-    
-    time_str, date_str, sender = [s.strip() for s in match.groups()]
-    role = 'me' if sender == "You" or (sender and config.YOUR_WHATSAPP_NAME in sender) else 'user'
-    if sender == "You": sender = config.YOUR_WHATSAPP_NAME
+    metadata = _parse_bubble_metadata(soup)
+    if not metadata: return None
 
-    content, attachment_filename = None, None
+    content, attachment_filename, attachment_ref = None, None, None
 
-    # --- THIS IS THE KEY CHANGE ---
     # Find elements WITHIN the message_element, not the global driver
-    doc_container = find_element_if_exists(message_element, By.CSS_SELECTOR, "div[role='button'][title^='Download']")
-    image_container = find_element_if_exists(message_element, By.CSS_SELECTOR, "div[role='button'][aria-label='Open picture']")
-    video_container = find_element_if_exists(message_element, By.CSS_SELECTOR, "span[data-icon='media-play']")
+    containers = probe(driver, _MEDIA_CONTAINER_KEYS, scope=message_element)
+    doc_container = containers["message_document_container"]
+    image_container = containers["message_image_container"]
+    video_container = containers["message_video_container"]
+    media_key = _media_key(message_id, html_snippet) if doc_container or image_container or video_container else None
 
     if doc_container:
-        content, attachment_filename = _handle_document_download(driver, doc_container, downloaded_files_set)
+        expected_filename = (doc_container.get_attribute('title') or "").removeprefix("Download").strip().strip('"\'')
+        if not force_download:
+            attachment_ref = _attachment_ref("document", soup, media_key, expected_filename, message_id)
+        if attachment_ref:
+            content = f"📎 Document: {expected_filename}"
+        else:
+            content, attachment_filename = _handle_document_download(driver, doc_container, media_key, message_id)
 
     elif image_container or video_container:
         media_type = "🎥 Video" if video_container else "📷 Image"
-        element_to_click = video_container.find_element(By.XPATH, "./ancestor::div[@role='button'][1]") if video_container else image_container
-        content, attachment_filename = _handle_media_viewer_download(driver, element_to_click, media_type, downloaded_files_set)
+        kind = "video" if video_container else "image"
+        if not force_download:
+            attachment_ref = _attachment_ref(kind, soup, media_key, _media_target_name(kind, media_key), message_id)
+        if attachment_ref:
+            content = f"{media_type} ({attachment_ref['target_name']})"
+        else:
+            element_to_click = video_container or image_container
+            content, attachment_filename = _handle_media_viewer_download(driver, element_to_click, media_type, media_key, message_id)
 
     # ... (your other elifs for voice, location etc.) ...
 
@@ -1271,9 +1652,35 @@ def process_live_message_element(driver, message_element: WebElement, downloaded
         content = text_span.text.strip() if text_span else None
 
     if not content: return None
+    return _build_message(*metadata, content, attachment_filename, attachment_ref, media_key)
 
-    unique_meta_text = f"[{time_str}, {date_str}] {sender}: {content}"
-    return {"date": date_str, "time": time_str, "sender": sender, "content": content, "meta_text": unique_meta_text, "role": role, "attachment_filename": attachment_filename}
+
+def fetch_deferred_attachment(driver, ref, session_id=None):
+    """
+    Downloads an attachment that sync only recorded: opens its chat, walks up to the
+    bubble with the stored data-id and runs the normal download path on it.
+    Returns the attachment filename, or None if the message could not be found.
+    """
+    if not ref.get("message_id"):
+        return None
+    name, _ = open_chat(driver, ref["chat_title"], set(), session_id=session_id)
+    if not name:
+        return None
+    try:
+        chat_container = get_element(driver, "chat_container", timeout=10)
+        if not chat_container:
+            return None
+        if not any(bubble["id"] == ref["message_id"] for bubble in _iter_bubbles_upward(driver, chat_container)):
+            print(f"   ⚠️ Message for '{ref['target_name']}' is no longer in the chat.")
+            return None
+        message_element = driver.find_element(By.XPATH, f"//*[@data-id=\"{ref['message_id']}\"]")
+        driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", message_element)
+        parsed = process_live_message_element(driver, message_element, ref["message_id"], force_download=True)
+        if not parsed or download_manager.drain_download_queue(driver):
+            return None
+        return parsed.get("attachment_filename")
+    finally:
+        close_current_chat(driver)
 
 # You will also need find_element_if_exists, _handle_document_download, 
 # and _handle_media_viewer_download from the previous answers.
@@ -1308,10 +1715,27 @@ def get_qr_base64(driver):
         print(f"❌ QR Extraction failed: {e}")
         return None
 
-def open_whatsapp(headless=True, session_id="default"):
-    from storage_manager import download_session
-    # Download existing session if available
-    download_session(session_id)
+LAUNCH_MODES = ("login", "sync")
+
+def _apply_launch_profile(driver, mode):
+    """Blocks the sync profile's unneeded fetches (avatars, stickers) for this driver."""
+    if mode != "sync" or not config.SYNC_BLOCKED_URL_PATTERNS:
+        return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": config.SYNC_BLOCKED_URL_PATTERNS})
+    except WebDriverException as e:
+        print(f"⚠️ Could not apply sync-mode request blocking: {e}")
+
+
+def open_whatsapp(headless=True, session_id="default", mode="login"):
+    """
+    Launches Chrome on the session's profile and opens WhatsApp Web.
+    mode="login" loads everything; mode="sync" drops avatar and sticker fetches.
+    """
+    if mode not in LAUNCH_MODES:
+        raise ValueError(f"Unknown launch mode '{mode}', expected one of {LAUNCH_MODES}")
+    # The caller restores profiles/<session_id> from storage first (see profile_transfers.py)
 
     options = Options()
     if headless:
@@ -1325,6 +1749,8 @@ def open_whatsapp(headless=True, session_id="default"):
     options.add_argument("--disable-software-rasterizer")
     options.add_argument("--disable-notifications")
     options.add_argument("--disable-popup-blocking")
+    if mode == "sync":
+        options.add_argument("--mute-audio")
     
     # Disable images/css for faster loading (QR is a canvas, so it still works)
     prefs = {"profile.managed_default_content_settings.images": 2}
@@ -1332,6 +1758,10 @@ def open_whatsapp(headless=True, session_id="default"):
     
     # Use a small window size to save RAM
     options.add_argument("--window-size=1024,768")
+
+    # Page events in the performance log carry the CDP download notifications
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": False, "enablePage": True})
     
     # Session Path
     base_path = os.getcwd()
@@ -1339,24 +1769,19 @@ def open_whatsapp(headless=True, session_id="default"):
     options.add_argument(f"--user-data-dir={profile_path}")
 
     try:
-        from webdriver_manager.chrome import ChromeDriverManager
-        from selenium.webdriver.chrome.service import Service
-        
-        driver_path = ChromeDriverManager().install()
-        
-        # Linux Path Fix
-        if platform.system() != "Windows":
-            if "THIRD_PARTY_NOTICES" in driver_path or os.path.isdir(driver_path):
-                parent_dir = os.path.dirname(driver_path) if "THIRD_PARTY_NOTICES" in driver_path else driver_path
-                driver_path = os.path.join(parent_dir, "chromedriver")
-            os.chmod(driver_path, 0o755)
-
-        service = Service(executable_path=driver_path)
-        driver = webdriver.Chrome(service=service, options=options)
+        try:
+            driver = webdriver.Chrome(service=Service(executable_path=resolve_chromedriver_path()), options=options)
+        except SessionNotCreatedException:
+            # Chrome was updated past the pinned driver; re-resolve once
+            print("⚠️ Pinned ChromeDriver does not match Chrome. Re-resolving...")
+            driver = webdriver.Chrome(service=Service(executable_path=resolve_chromedriver_path(refresh=True)), options=options)
         
         # Set generous timeouts for slow CPUs
         driver.set_page_load_timeout(120)
         driver.set_script_timeout(120)
+
+        download_manager.enable_download_tracking(driver, config.ATTACHMENTS_DIR)
+        _apply_launch_profile(driver, mode)
         
         print("📱 Navigating to WhatsApp Web...")
         driver.get("https://web.whatsapp.com")
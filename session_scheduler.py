@@ -0,0 +1,108 @@
+# session_scheduler.py
+import heapq
+import itertools
+import threading
+import time
+
+
+class SessionScheduler:
+    """
+    Decides when each session is synced next. Sessions sit in a heap keyed on
+    their next-due time, so whichever has waited longest past its due time runs
+    first. Each session's interval follows its smoothed (EWMA) message arrival
+    rate: busy sessions are revisited after roughly target_messages new messages,
+    quiet ones back off (doubling) toward max_interval. A session with an unread
+    backlog left over is revisited at min_interval. max_interval bounds how long
+    any session can wait.
+    """
+
+    def __init__(self, min_interval, max_interval, base_interval, target_messages=5, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base_interval = base_interval
+        self.target_messages = target_messages
+        self.smoothing = smoothing
+        self.heap = []               # (due, seq, session_id); superseded entries are skipped
+        self.next_due = {}           # session_id -> due time of its live heap entry
+        self.stats = {}              # session_id -> {"rate", "interval", "last_run"}
+        self.active = set()          # sessions that still exist in storage
+        self.running = set()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def set_sessions(self, session_ids):
+        """Adds new sessions (due immediately) and forgets ones that no longer exist."""
+        with self.lock:
+            self.active = set(session_ids)
+            for session_id in self.active - set(self.next_due) - self.running:
+                self._push(session_id, time.time())
+            for session_id in list(self.stats):
+                if session_id not in self.active: del self.stats[session_id]
+
+    def pop_due(self):
+        """Returns the most overdue session, or None if nothing is due yet."""
+        with self.lock:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, _, session_id = heapq.heappop(self.heap)
+                if self.next_due.get(session_id) != due: continue
+                del self.next_due[session_id]
+                if session_id in self.active:
+                    self.running.add(session_id)
+                    return session_id
+            return None
+
+    def wake(self, session_id):
+        """Makes a waiting session due now, e.g. when replies are ready to be sent."""
+        with self.lock:
+            if session_id in self.active and session_id not in self.running:
+                self._push(session_id, time.time())
+
+    def upcoming(self, count, horizon):
+        """The next `count` sessions due within `horizon` seconds that aren't running."""
+        with self.lock:
+            limit = time.time() + horizon
+            soon = sorted(entry for entry in self.heap if entry[0] <= limit and self.next_due.get(entry[2]) == entry[0])
+            session_ids = []
+            for _, _, session_id in soon:
+                if session_id in self.active and session_id not in self.running and session_id not in session_ids:
+                    session_ids.append(session_id)
+            return session_ids[:count]
+
+    def seconds_until_next(self):
+        with self.lock:
+            return max(0.0, min(self.next_due.values()) - time.time()) if self.next_due else self.max_interval
+
+    def record(self, session_id, stats):
+        """
+        Reschedules a session after a sync. stats is what process_single_user returned
+        ({"new_messages", "unread_backlog"}), or None if the sync was skipped or failed.
+        """
+        now = time.time()
+        with self.lock:
+            self.running.discard(session_id)
+            if session_id not in self.active:
+                return
+            if stats is None:
+                self._push(session_id, now + self.min_interval)
+                return
+
+            state = self.stats.setdefault(session_id, {"rate": 0.0, "interval": self.base_interval, "last_run": now - self.base_interval})
+            elapsed = max(now - state["last_run"], 1.0)
+            sample = stats.get("new_messages", 0) / elapsed
+            state["rate"] = self.smoothing * sample + (1 - self.smoothing) * state["rate"]
+            state["last_run"] = now
+
+            if stats.get("unread_backlog"):
+                interval = self.min_interval
+            elif state["rate"] > 0:
+                interval = self.target_messages / state["rate"]
+            else:
+                interval = state["interval"] * 2
+            state["interval"] = min(self.max_interval, max(self.min_interval, interval))
+            self._push(session_id, now + state["interval"])
+        print(f"   🗓️ Next sync for {session_id} in {state['interval']:.0f}s ({state['rate'] * 3600:.1f} msg/h).")
+
+    def _push(self, session_id, due):
+        self.next_due[session_id] = due
+        heapq.heappush(self.heap, (due, next(self.counter), session_id))
@@ -0,0 +1,180 @@
+# storage_backends.py
+import os
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+import httpx
+import config
+
+BLOCK_SIZE = 1024 * 1024
+LIST_PAGE_SIZE = 1000  # Supabase caps one list call at this many entries
+
+
+def _status_code(error):
+    """HTTP status behind a storage client error, however the client version reports it."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code
+    details = error.args[0] if error.args and isinstance(error.args[0], dict) else {}
+    try:
+        return int(details.get("statusCode") or details.get("status"))
+    except (TypeError, ValueError):
+        return None
+
+
+class SupabaseBackend:
+    """
+    Objects in a Supabase Storage bucket. The client is created on first use, so
+    importing this module needs neither network access nor the supabase package.
+    Missing objects raise FileNotFoundError.
+    """
+
+    def __init__(self, url, key, bucket):
+        self.url, self.key, self.bucket_name = url, key, bucket
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _bucket(self):
+        with self._lock:
+            if self._client is None:
+                from supabase import create_client, ClientOptions
+                self._client = create_client(self.url, self.key, options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=60))
+        return self._client.storage.from_(self.bucket_name)
+
+    def _object_url(self, path):
+        return f"{self.url}/storage/v1/object/{self.bucket_name}/{path}"
+
+    def _auth_headers(self):
+        return {"Authorization": f"Bearer {self.key}", "apikey": self.key}
+
+    def _entries(self, prefix):
+        """Every listing entry directly under prefix, read page by page until a short page."""
+        entries, offset = [], 0
+        while True:
+            page = self._bucket().list(prefix, {"limit": LIST_PAGE_SIZE, "offset": offset})
+            entries += page
+            if len(page) < LIST_PAGE_SIZE:
+                return entries
+            offset += LIST_PAGE_SIZE
+
+    def list(self, prefix=""):
+        """Names of the objects directly under prefix."""
+        return [f["name"] for f in self._entries(prefix)]
+
+    def list_modified(self, prefix):
+        """{name: last-modified epoch seconds} for the objects (not folders) directly under prefix."""
+        return {f["name"]: datetime.fromisoformat(f["updated_at"]).timestamp()
+                for f in self._entries(prefix) if f.get("updated_at")}
+
+    def upload(self, path, data):
+        self._bucket().upload(path=path, file=data, file_options={"cache-control": "3600", "upsert": "true"})
+
+    def delete(self, paths):
+        for start in range(0, len(paths), LIST_PAGE_SIZE):
+            self._bucket().remove(paths[start:start + LIST_PAGE_SIZE])
+
+    def download(self, path):
+        try:
+            return self._bucket().download(path)
+        except Exception as e:
+            # Supabase answers 400 for missing objects; anything else (auth, network) is a real error
+            if _status_code(e) in (400, 404):
+                raise FileNotFoundError(path) from e
+            raise
+
+    def stat(self, path):
+        """Returns {"size"} for a stored object, or None if it doesn't exist."""
+        folder, _, name = path.rpartition("/")
+        for f in self._bucket().list(folder, {"limit": LIST_PAGE_SIZE, "search": name}):
+            if f["name"] == name:
+                return {"size": (f.get("metadata") or {}).get("size")}
+        return None
+
+    def upload_stream(self, path, blocks):
+        """Uploads an iterator of byte blocks with chunked transfer encoding, never holding it whole."""
+        headers = {**self._auth_headers(), "x-upsert": "true", "content-type": "application/octet-stream", "cache-control": "max-age=3600"}
+        response = httpx.post(self._object_url(path), content=blocks, headers=headers, timeout=httpx.Timeout(60, read=None))
+        response.raise_for_status()
+
+    @contextmanager
+    def download_stream(self, path):
+        """Yields an iterator over a stored object's bytes as they arrive."""
+        with httpx.stream("GET", self._object_url(path), headers=self._auth_headers(), timeout=httpx.Timeout(60, read=None)) as response:
+            if response.status_code in (400, 404):
+                raise FileNotFoundError(path)  # Supabase answers 400 for missing objects
+            response.raise_for_status()
+            yield response.iter_bytes(BLOCK_SIZE)
+
+
+class LocalBackend:
+    """
+    Objects as files under a local directory. Meant for offline runs and benchmarks;
+    writes go through a temporary file so readers never see half an object.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _file(self, path):
+        return os.path.join(self.root, *path.split("/"))
+
+    def _write(self, path, blocks):
+        dest = self._file(path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_file = f"{dest}.{threading.get_ident()}.part"
+        with open(tmp_file, "wb") as f:
+            for block in blocks:
+                f.write(block)
+        os.replace(tmp_file, dest)
+
+    def list(self, prefix=""):
+        folder = self._file(prefix) if prefix else self.root
+        try:
+            return [n for n in os.listdir(folder) if not n.endswith(".part")]
+        except OSError:
+            return []
+
+    def list_modified(self, prefix):
+        folder = self._file(prefix)
+        try:
+            names = [n for n in os.listdir(folder) if not n.endswith(".part")]
+        except OSError:
+            return {}
+        return {n: os.path.getmtime(os.path.join(folder, n)) for n in names if os.path.isfile(os.path.join(folder, n))}
+
+    def upload(self, path, data):
+        self._write(path, [data])
+
+    def delete(self, paths):
+        for path in paths:
+            try:
+                os.remove(self._file(path))
+            except FileNotFoundError:
+                pass
+
+    def download(self, path):
+        with open(self._file(path), "rb") as f:
+            return f.read()
+
+    def stat(self, path):
+        try:
+            return {"size": os.path.getsize(self._file(path))}
+        except OSError:
+            return None
+
+    def upload_stream(self, path, blocks):
+        self._write(path, blocks)
+
+    @contextmanager
+    def download_stream(self, path):
+        with open(self._file(path), "rb") as f:
+            yield iter(lambda: f.read(BLOCK_SIZE), b"")
+
+
+def create_backend():
+    """Builds the backend named by config.STORAGE_BACKEND."""
+    if config.STORAGE_BACKEND == "local":
+        return LocalBackend(config.STORAGE_LOCAL_DIR)
+    if config.STORAGE_BACKEND == "supabase":
+        return SupabaseBackend(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"), config.STORAGE_BUCKET)
+    raise ValueError(f"Unknown STORAGE_BACKEND '{config.STORAGE_BACKEND}', expected 'supabase' or 'local'")
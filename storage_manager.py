@@ -1,62 +1,625 @@
+import io
 import os
+import gzip
+import json
 import shutil
-from supabase import create_client, ClientOptions
+import fnmatch
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import time
+import config
+import bot_state
+import storage_backends
 
-url = os.getenv("SUPABASE_URL")
-key = os.getenv("SUPABASE_KEY")
-supabase = create_client(url, key, options=ClientOptions(postgrest_client_timeout=10, storage_client_timeout=60))
+try:
+    import zstandard  # Optional: faster archives. Falls back to gzip without it.
+except ImportError:
+    zstandard = None
 
-BUCKET_NAME = "whatsapp_data"
+PROFILES_DIR = "profiles"
+STREAM_BLOCK_SIZE = 1024 * 1024
+# Last manifest uploaded/restored per session, to skip rehashing unchanged files
+LOCAL_MANIFESTS_DIR = os.path.join(PROFILES_DIR, ".manifests")
+# Version, size and last use of every profile kept locally
+CACHE_INDEX_FILE = os.path.join(PROFILES_DIR, ".cache.json")
+_CACHE_LOCK = threading.Lock()
+_GC_LOCK = threading.Lock()
+_last_gc = 0
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# Hooks into the browser pool, registered by profile_transfers (this module sits below it).
+# evict_browser(session_id) closes an idle warm browser and returns True if it did;
+# browser_is_open(session_id) is True while any browser still has the profile open.
+evict_browser = None
+browser_is_open = None
+
+def backend():
+    """The storage backend chosen by config.STORAGE_BACKEND, created on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = storage_backends.create_backend()
+        return _backend
+
+def _upload_bytes(path, data):
+    backend().upload(path, data)
+
+def _download_bytes(path):
+    return backend().download(path)
 
 def upload_session(session_id="Owner"):
-    """Zips a SPECIFIC session folder and uploads it as session_id.zip"""
-    local_dir = f"profiles/{session_id}" # e.g., profiles/user123
-    
+    """Saves a session's profile to the cloud using config.PROFILE_SYNC_STRATEGY."""
+    local_dir = os.path.join(PROFILES_DIR, session_id) # e.g., profiles/user123
+
     if not os.path.exists(local_dir):
         return False
 
-    # Zip profiles/user123 -> user123.zip
-    shutil.make_archive(session_id, 'zip', local_dir)
-    
-    with open(f"{session_id}.zip", "rb") as f:
-        supabase.storage.from_(BUCKET_NAME).upload(
-            path=f"{session_id}.zip", 
-            file=f, 
-            file_options={"cache-control": "3600", "upsert": "true"}
-        )
-    os.remove(f"{session_id}.zip")
-    print(f"✅ Session '{session_id}' saved to Cloud.")
+    if config.PROFILE_SYNC_STRATEGY == "manifest":
+        version = upload_session_manifest(session_id)
+    else:
+        version = upload_session_archive(session_id)
+    if not version:
+        return False
+    _record_cache(session_id, version)
+    enforce_cache_budget(keep=(session_id,))
+    return True
 
 def download_session(session_id):
-    """Downloads session_id.zip if it exists."""
-    local_dir = f"profiles/{session_id}"
-    
-    # If we already have the folder locally, don't re-download (saves bandwidth/time)
+    """
+    Makes sure profiles/<session_id> holds the newest saved profile. A local copy is
+    used as-is when its version matches the small manifest/stamp in the bucket;
+    otherwise it is refreshed from the manifest, the archive, or the legacy session_id.zip.
+    """
+    local_dir = os.path.join(PROFILES_DIR, session_id)
+    try:
+        raw_manifest = _fetch_object(_manifest_path(session_id))
+        stamp = None if raw_manifest else _fetch_archive_stamp(session_id)
+    except Exception as e:
+        # Unreachable is not the same as missing: never treat it as a new session
+        print(f"❌ Could not check cloud for '{session_id}': {e}")
+        if os.path.exists(local_dir):
+            print(f"⚠️ Using the local copy of '{session_id}'.")
+            _record_cache(session_id)
+            return True
+        return False
+    remote_version = _version_of(raw_manifest) if raw_manifest else (stamp or {}).get("version")
+
     if os.path.exists(local_dir):
-        print(f"📂 Local profile '{session_id}' found. Using it.")
+        # Without a remote version (legacy zip only) the local copy wins
+        if remote_version is None or _cache_entry(session_id).get("version") == remote_version:
+            print(f"📂 Local profile '{session_id}' is current. Using it.")
+            _record_cache(session_id)
+            return True
+        print(f"🔄 Local profile '{session_id}' is stale. Refreshing from cloud...")
+        # A warm browser must not keep running on files that are about to be swapped out
+        if evict_browser:
+            evict_browser(session_id)
+    else:
+        print(f"📥 Checking cloud for '{session_id}'...")
+
+    if raw_manifest:
+        restored = restore_from_manifest(session_id, json.loads(raw_manifest))
+    elif stamp:
+        restored = restore_from_archive(session_id, stamp.get("codec"))
+    else:
+        restored = restore_from_archive(session_id) or _restore_legacy_zip(session_id)
+    if restored:
+        _record_cache(session_id, remote_version)
+        enforce_cache_budget(keep=(session_id,))
+        return True
+    if os.path.exists(local_dir):
+        print(f"⚠️ Refresh failed. Using the local copy of '{session_id}'.")
         return True
+    return False
 
-    print(f"📥 Checking cloud for '{session_id}'...")
+def _restore_legacy_zip(session_id):
+    local_dir = os.path.join(PROFILES_DIR, session_id)
     try:
-        res = supabase.storage.from_(BUCKET_NAME).download(f"{session_id}.zip")
-        with open("restore.zip", "wb") as f:
+        res = _download_bytes(f"{session_id}.zip")
+        # Legacy zips need a seekable file; a private temp file keeps sessions apart
+        with tempfile.TemporaryFile() as f:
             f.write(res)
-        
-        shutil.unpack_archive("restore.zip", local_dir)
-        os.remove("restore.zip")
+            with zipfile.ZipFile(f) as archive:
+                archive.extractall(local_dir)
         return True
-    except Exception:
-        # Silent fail is better here. It just means "New User"
+    except FileNotFoundError:
+        # It just means "New User"
         print(f"ℹ️ New session '{session_id}' will be created.")
         return False
-    
+    except Exception as e:
+        print(f"❌ Could not restore '{session_id}' from its legacy zip: {e}")
+        return False
+
 def list_available_sessions():
-    """Returns a list of .zip files in the bucket."""
+    """
+    Returns the ids of all sessions in storage, as manifests, archives or legacy zips.
+    backend().list() reads every page, so large buckets are listed in full.
+    """
     try:
-        # Supabase storage list API
-        files = supabase.storage.from_(BUCKET_NAME).list()
-        # Filter only zip files
-        return [f['name'] for f in files if f['name'].endswith('.zip')]
+        sessions = {name.removesuffix('.zip') for name in backend().list() if name.endswith('.zip')}
+        sessions |= {name.removesuffix('.json') for name in backend().list("manifests") if name.endswith('.json')}
+        sessions |= {name.split('.tar.')[0] for name in backend().list("archives") if '.tar.' in name}
+        return sorted(sessions)
     except Exception as e:
         print(f"Error listing sessions: {e}")
-        return []
\ No newline at end of file
+        return []
+
+
+# --- Manifest-based profile sync ---
+# A profile is stored as content-addressed chunks (chunks/<xx>/<hash>) plus a small
+# manifest (manifests/<session_id>.json) listing each file's size, mtime and chunks.
+# Chunks already referenced by the previous manifest are never uploaded again, so a
+# cycle only transfers what Chrome actually changed.
+
+def _manifest_path(session_id):
+    return f"manifests/{session_id}.json"
+
+def _chunk_path(chunk_hash):
+    return f"chunks/{chunk_hash[:2]}/{chunk_hash}"
+
+def _local_manifest_file(session_id):
+    return os.path.join(LOCAL_MANIFESTS_DIR, f"{session_id}.json")
+
+def _load_local_manifest(session_id):
+    try:
+        with open(_local_manifest_file(session_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_local_manifest(session_id, manifest):
+    os.makedirs(LOCAL_MANIFESTS_DIR, exist_ok=True)
+    tmp_file = _local_manifest_file(session_id) + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, _local_manifest_file(session_id))
+
+def _fetch_object(path):
+    """An object's bytes, or None if it doesn't exist. Network and auth errors propagate."""
+    try:
+        return _download_bytes(path)
+    except FileNotFoundError:
+        return None
+
+def _fetch_manifest(session_id):
+    raw = _fetch_object(_manifest_path(session_id))
+    return json.loads(raw) if raw else None
+
+def _version_of(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def _matches(rel_path, patterns):
+    """True if the path or any of its parent folders matches one of the patterns."""
+    parts = rel_path.split("/")
+    prefixes = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    return any(fnmatch.fnmatchcase(prefix, pattern) for prefix in prefixes for pattern in patterns)
+
+def select_profile_files(local_dir):
+    """
+    Applies config.PROFILE_SLIM_MODE to a profile. Returns the [(relative_path,
+    absolute_path)] worth saving and a report of what was kept and skipped.
+    """
+    files = []
+    report = {"kept_files": 0, "kept_bytes": 0, "skipped_files": 0, "skipped_bytes": 0}
+    for root, _, names in os.walk(local_dir):
+        for name in names:
+            full_path = os.path.join(root, name)
+            if os.path.islink(full_path): continue  # Chrome's Singleton* lock links
+            rel_path = os.path.relpath(full_path, local_dir).replace(os.sep, "/")
+            try: size = os.path.getsize(full_path)
+            except OSError: continue
+            if config.PROFILE_SLIM_MODE == "minimal":
+                keep = _matches(rel_path, config.PROFILE_MINIMAL_SET)
+            else:
+                keep = not _matches(rel_path, config.PROFILE_EXCLUDE)
+            if keep:
+                files.append((rel_path, full_path))
+                report["kept_files"] += 1; report["kept_bytes"] += size
+            else:
+                report["skipped_files"] += 1; report["skipped_bytes"] += size
+    return files, report
+
+def _print_slim_report(session_id, report):
+    total = report["kept_bytes"] + report["skipped_bytes"]
+    saved = 100 * report["skipped_bytes"] / total if total else 0
+    print(f"🧹 Profile '{session_id}': keeping {report['kept_files']} files ({report['kept_bytes'] / 1e6:.1f} MB), "
+          f"skipped {report['skipped_files']} ({report['skipped_bytes'] / 1e6:.1f} MB, {saved:.0f}% saved).")
+
+def _iter_chunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(config.PROFILE_CHUNK_SIZE), b""):
+            yield chunk
+
+def build_and_upload_manifest(session_id, previous=None):
+    """
+    Hashes the profile into chunks, uploads the chunks the previous manifest doesn't
+    already reference, and returns (manifest, bytes_uploaded). Files whose size and
+    mtime match the previous manifest are not even reread.
+    """
+    local_dir = os.path.join(PROFILES_DIR, session_id)
+    previous_files = (previous or {}).get("files", {})
+    known_chunks = {h for entry in previous_files.values() for h in entry["chunks"]}
+    files, uploaded = {}, 0
+
+    selected, report = select_profile_files(local_dir)
+    _print_slim_report(session_id, report)
+    for rel_path, full_path in selected:
+        try:
+            stat = os.stat(full_path)
+            old = previous_files.get(rel_path)
+            if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+                files[rel_path] = old
+                continue
+            chunks = []
+            for chunk in _iter_chunks(full_path):
+                chunk_hash = hashlib.blake2b(chunk, digest_size=20).hexdigest()
+                if chunk_hash not in known_chunks:
+                    _upload_bytes(_chunk_path(chunk_hash), chunk)
+                    known_chunks.add(chunk_hash)
+                    uploaded += len(chunk)
+                chunks.append(chunk_hash)
+        except OSError:
+            continue  # Chrome removed or locked the file mid-walk; it'll be picked up next cycle
+        files[rel_path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "chunks": chunks}
+
+    return {"version": 1, "session_id": session_id, "chunk_size": config.PROFILE_CHUNK_SIZE, "files": files}, uploaded
+
+def upload_session_manifest(session_id):
+    """
+    Uploads only the changed chunks of a profile, then switches its manifest over.
+    Returns the manifest's version, or None on failure.
+    """
+    try:
+        previous = _load_local_manifest(session_id) or _fetch_manifest(session_id)
+    except Exception as e:
+        # Without the previous manifest every chunk would be uploaded again
+        print(f"❌ Could not save session '{session_id}': manifest unreachable: {e}")
+        return None
+    manifest, uploaded = build_and_upload_manifest(session_id, previous)
+    if previous and manifest["files"] == previous.get("files"):
+        print(f"✅ Session '{session_id}' unchanged. Nothing uploaded.")
+        return _version_of(json.dumps(previous).encode("utf-8"))
+
+    # The manifest goes last, so a crash mid-upload leaves the old profile intact
+    data = json.dumps(manifest).encode("utf-8")
+    _upload_bytes(_manifest_path(session_id), data)
+    _save_local_manifest(session_id, manifest)
+    total = sum(entry["size"] for entry in manifest["files"].values())
+    print(f"✅ Session '{session_id}' saved to Cloud ({uploaded / 1e6:.1f} MB of {total / 1e6:.1f} MB uploaded).")
+    _maybe_collect_garbage()
+    return _version_of(data)
+
+def _maybe_collect_garbage():
+    """Runs collect_garbage_chunks if the last sweep is older than the configured interval."""
+    global _last_gc
+    if not _GC_LOCK.acquire(blocking=False):
+        return  # Another upload is already sweeping
+    try:
+        if time.time() - _last_gc < config.PROFILE_CHUNK_GC_INTERVAL_SECONDS:
+            return
+        _last_gc = time.time()
+        collect_garbage_chunks()
+    except Exception as e:
+        print(f"⚠️ Chunk garbage collection failed: {e}")
+    finally:
+        _GC_LOCK.release()
+
+def collect_garbage_chunks(grace_seconds=None):
+    """
+    Mark-and-sweep over chunks/: deletes every chunk no manifests/*.json references
+    that is older than the grace period, so chunks a save has uploaded ahead of its
+    manifest survive. Returns the number of chunks deleted.
+    """
+    grace = config.PROFILE_CHUNK_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    cutoff = time.time() - grace
+    # Mark: manifests are read before chunks are listed, so a chunk a newer manifest
+    # picks up in between is either already live or younger than the cutoff
+    live = set()
+    for name in backend().list("manifests"):
+        if not name.endswith(".json"): continue
+        try:
+            manifest = json.loads(_download_bytes(f"manifests/{name}"))
+        except FileNotFoundError:
+            continue  # Deleted since the listing
+        live.update(h for entry in manifest["files"].values() for h in entry["chunks"])
+
+    # Sweep
+    garbage = []
+    for prefix in backend().list("chunks"):
+        for chunk_hash, modified in backend().list_modified(f"chunks/{prefix}").items():
+            if chunk_hash not in live and modified < cutoff:
+                garbage.append(_chunk_path(chunk_hash))
+    if garbage:
+        backend().delete(garbage)
+    print(f"🧹 Chunk GC: {len(live)} live chunks, deleted {len(garbage)} unreferenced.")
+    return len(garbage)
+
+def _unchanged_local_file(local_dir, rel_path, entry, local_files):
+    """
+    Path of the local copy of a file when it provably holds the chunks `entry` lists:
+    the last manifest on this node had the same chunks, and size/mtime show it
+    hasn't been touched since. Such files are copied instead of downloaded.
+    """
+    old = local_files.get(rel_path)
+    if not old or old["chunks"] != entry["chunks"]:
+        return None
+    path = os.path.join(local_dir, *rel_path.split("/"))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path if stat.st_size == old["size"] and stat.st_mtime_ns == old["mtime"] else None
+
+def _swap_in(staging_dir, local_dir):
+    """Replaces local_dir with a freshly restored staging_dir."""
+    if os.path.exists(local_dir):
+        old_dir = f"{local_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(local_dir, old_dir)
+        os.replace(staging_dir, local_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.replace(staging_dir, local_dir)
+
+def restore_from_manifest(session_id, manifest):
+    """Rebuilds profiles/<session_id> from its manifest's chunks, reusing unchanged local files."""
+    local_dir = os.path.join(PROFILES_DIR, session_id)
+    staging_dir = f"{local_dir}.restoring"
+    local_files = (_load_local_manifest(session_id) or {}).get("files", {}) if os.path.exists(local_dir) else {}
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    reused = 0
+    try:
+        for rel_path, entry in manifest["files"].items():
+            dest = os.path.join(staging_dir, *rel_path.split("/"))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            source = _unchanged_local_file(local_dir, rel_path, entry, local_files)
+            if source:
+                shutil.copyfile(source, dest)
+                reused += 1
+            else:
+                with open(dest, "wb") as f:
+                    for chunk_hash in entry["chunks"]:
+                        f.write(_download_bytes(_chunk_path(chunk_hash)))
+            os.utime(dest, ns=(entry["mtime"], entry["mtime"]))
+    except Exception as e:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        print(f"❌ Could not restore '{session_id}' from its manifest: {e}")
+        return False
+
+    _swap_in(staging_dir, local_dir)
+    _save_local_manifest(session_id, manifest)
+    if reused:
+        print(f"   ♻️ Reused {reused} unchanged local files.")
+    print(f"📂 Restored '{session_id}' from manifest ({len(manifest['files'])} files).")
+    return True
+
+
+# --- Streaming archives ---
+# With PROFILE_SYNC_STRATEGY="archive" a profile is stored as one compressed tar,
+# archives/<session_id>.tar.zst (or .tar.gz without zstandard). The tar is produced
+# in a thread straight into a pipe that feeds the upload, and restores decompress
+# the download as it arrives, so no archive ever touches the disk.
+
+ARCHIVE_CODECS = ("zst", "gz")
+
+def _archive_path(session_id, codec):
+    return f"archives/{session_id}.tar.{codec}"
+
+def _archive_stamp_path(session_id):
+    """Small JSON next to the archive naming its codec and version (hash of the archive)."""
+    return f"archives/{session_id}.json"
+
+def _fetch_archive_stamp(session_id):
+    raw = _fetch_object(_archive_stamp_path(session_id))
+    return json.loads(raw) if raw else None
+
+def _hashing(blocks, digest):
+    for block in blocks:
+        digest.update(block)
+        yield block
+
+class _FixedSizeReader:
+    """
+    Reads exactly `size` bytes from a file that Chrome may still be writing:
+    truncates growth and zero-pads shrinkage so the tar stream stays valid.
+    """
+    def __init__(self, f, size):
+        self.f, self.remaining = f, size
+
+    def read(self, n=-1):
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        data = self.f.read(n)
+        data += b"\0" * (n - len(data))
+        self.remaining -= n
+        return data
+
+def _write_tar(fileobj, files):
+    with tarfile.open(fileobj=fileobj, mode="w|") as archive:
+        for rel_path, full_path in files:
+            try:
+                with open(full_path, "rb") as f:
+                    info = archive.gettarinfo(arcname=rel_path, fileobj=f)
+                    archive.addfile(info, _FixedSizeReader(f, info.size))
+            except FileNotFoundError:
+                continue  # Removed by Chrome after the walk
+
+def _stream_archive(files, codec):
+    """Yields the compressed tar of `files` block by block; memory stays at one pipe buffer."""
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with open(write_fd, "wb") as pipe_out:
+                if codec == "zst":
+                    with zstandard.ZstdCompressor(level=config.PROFILE_ARCHIVE_LEVEL).stream_writer(pipe_out, closefd=False) as compressed:
+                        _write_tar(compressed, files)
+                else:
+                    with gzip.GzipFile(fileobj=pipe_out, mode="wb", compresslevel=config.PROFILE_ARCHIVE_LEVEL) as compressed:
+                        _write_tar(compressed, files)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    with open(read_fd, "rb") as pipe_in:
+        for block in iter(lambda: pipe_in.read(STREAM_BLOCK_SIZE), b""):
+            yield block
+    producer.join()
+    if errors:
+        raise errors[0]
+
+def upload_session_archive(session_id):
+    """
+    Streams the slimmed profile as one compressed tar straight into the bucket, then
+    its stamp. Returns the archive's version, or None on failure.
+    """
+    local_dir = os.path.join(PROFILES_DIR, session_id)
+    files, report = select_profile_files(local_dir)
+    _print_slim_report(session_id, report)
+    codec = "zst" if zstandard else "gz"
+    digest = hashlib.blake2b(digest_size=20)
+    try:
+        backend().upload_stream(_archive_path(session_id, codec), _hashing(_stream_archive(files, codec), digest))
+        version = digest.hexdigest()
+        _upload_bytes(_archive_stamp_path(session_id), json.dumps({"version": version, "codec": codec}).encode("utf-8"))
+    except Exception as e:
+        print(f"❌ Could not save session '{session_id}': {e}")
+        return None
+    print(f"✅ Session '{session_id}' saved to Cloud.")
+    return version
+
+class _IteratorReader(io.RawIOBase):
+    """File-like view over an iterator of byte blocks, for the streaming decompressors."""
+    def __init__(self, blocks):
+        self.blocks, self.pending = blocks, b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.blocks, b"")
+            if not self.pending: return 0
+        n = min(len(buffer), len(self.pending))
+        buffer[:n], self.pending = self.pending[:n], self.pending[n:]
+        return n
+
+def restore_from_archive(session_id, codec=None):
+    """Restores profiles/<session_id> by decompressing and untarring its archive as it downloads."""
+    local_dir = os.path.join(PROFILES_DIR, session_id)
+    staging_dir = f"{local_dir}.restoring"
+    codecs = [codec] if codec else [c for c in ARCHIVE_CODECS if c == "gz" or zstandard]
+    for codec in codecs:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        try:
+            with backend().download_stream(_archive_path(session_id, codec)) as blocks:
+                raw = io.BufferedReader(_IteratorReader(blocks), STREAM_BLOCK_SIZE)
+                if codec == "zst":
+                    stream = zstandard.ZstdDecompressor().stream_reader(raw)
+                else:
+                    stream = gzip.GzipFile(fileobj=raw, mode="rb")
+                with tarfile.open(fileobj=stream, mode="r|") as archive:
+                    archive.extractall(staging_dir, filter="data")
+        except FileNotFoundError:
+            continue  # No archive in this format
+        except Exception as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            print(f"❌ Could not restore '{session_id}' from its archive: {e}")
+            return False
+        _swap_in(staging_dir, local_dir)
+        print(f"📂 Restored '{session_id}' from {_archive_path(session_id, codec)}.")
+        return True
+    return False
+
+
+# --- Local profile cache ---
+# profiles/ keeps recently used profiles so a cycle can skip the download. The index
+# records each one's version (to detect copies another node has since replaced),
+# size and last use. Above config.PROFILE_CACHE_MAX_MB the least recently used
+# profiles are deleted, except ones a task is using right now.
+
+def _load_cache_index():
+    try:
+        with open(CACHE_INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache_index(index):
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    tmp_file = f"{CACHE_INDEX_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, CACHE_INDEX_FILE)
+
+def _cache_entry(session_id):
+    with _CACHE_LOCK:
+        return _load_cache_index().get(session_id, {})
+
+def _dir_size(path):
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try: total += os.lstat(os.path.join(root, name)).st_size
+            except OSError: continue
+    return total
+
+def _record_cache(session_id, version=None):
+    """Marks a local profile as just used; pass version after a restore or upload."""
+    size = _dir_size(os.path.join(PROFILES_DIR, session_id))
+    with _CACHE_LOCK:
+        index = _load_cache_index()
+        entry = index.setdefault(session_id, {})
+        if version: entry["version"] = version
+        entry.update(size=size, last_used=time.time())
+        _save_cache_index(index)
+
+def _cached_sessions():
+    """Session folders under profiles/, without restore/manifest scratch folders."""
+    try:
+        names = os.listdir(PROFILES_DIR)
+    except OSError:
+        return []
+    return [n for n in names if not n.startswith(".") and not n.endswith((".restoring", ".old"))
+            and os.path.isdir(os.path.join(PROFILES_DIR, n))]
+
+def enforce_cache_budget(keep=()):
+    """Deletes least recently used local profiles until profiles/ fits PROFILE_CACHE_MAX_MB."""
+    if not config.PROFILE_CACHE_MAX_MB:
+        return
+    with _CACHE_LOCK:
+        index = _load_cache_index()
+    sessions = _cached_sessions()
+    sizes = {s: index.get(s, {}).get("size") or _dir_size(os.path.join(PROFILES_DIR, s)) for s in sessions}
+    usage = sum(sizes.values())
+    budget = config.PROFILE_CACHE_MAX_MB * 1024 * 1024
+
+    for session_id in sorted(sessions, key=lambda s: index.get(s, {}).get("last_used", 0)):
+        if usage <= budget: break
+        if session_id in keep: continue
+        # A held session lock means a sync, login or send is using this profile
+        lock = bot_state.get_session_lock(session_id)
+        if not lock.acquire(blocking=False): continue
+        try:
+            # Close its idle warm browser first; a leased one means it's in use
+            if evict_browser and evict_browser(session_id):
+                upload_session(session_id)  # Changes made while it was warm weren't saved yet
+            elif browser_is_open and browser_is_open(session_id):
+                continue
+            shutil.rmtree(os.path.join(PROFILES_DIR, session_id), ignore_errors=True)
+            try: os.remove(_local_manifest_file(session_id))
+            except OSError: pass
+            with _CACHE_LOCK:
+                index = _load_cache_index()
+                index.pop(session_id, None)
+                _save_cache_index(index)
+            usage -= sizes[session_id]
+            print(f"🗑️ Evicted local profile '{session_id}' ({sizes[session_id] / 1e6:.1f} MB) from the cache.")
+        finally:
+            lock.release()
@@ -0,0 +1,30 @@
+# tests/test_chat_identity.py
+import pytest
+import database_manager
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database_manager, "DB_NAME", str(tmp_path / "test.db"))
+    database_manager.init_db()
+
+
+def test_renamed_row_is_found_by_chat_id():
+    database_manager.save_chat_identity("s1", "Bob", "Bob", "+8801711111111", "8801711111111@c.us")
+
+    # The chat list now shows the same chat under a new title
+    identity = database_manager.get_chat_identity("s1", "Robert", "8801711111111@c.us")
+    assert identity["title"] == "Bob"
+    assert identity["phone_number"] == "+8801711111111"
+
+    database_manager.save_chat_identity("s1", "Robert", "Robert", identity["phone_number"], identity["chat_id"])
+    assert database_manager.get_chat_identity("s1", "Robert", "8801711111111@c.us")["contact_name"] == "Robert"
+    assert database_manager.get_chat_identity("s1", "Bob") is None
+
+
+def test_title_lookup_without_chat_id_and_other_sessions_untouched():
+    database_manager.save_chat_identity("s1", "Team", "Team", None)
+    database_manager.save_chat_identity("s2", "Bob", "Bob", "+8801711111111")
+
+    assert database_manager.get_chat_identity("s1", "Team", "unknown@g.us")["contact_name"] == "Team"
+    assert database_manager.get_chat_identity("s1", "Robert", "8801711111111@c.us") is None
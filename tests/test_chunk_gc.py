@@ -0,0 +1,72 @@
+# tests/test_chunk_gc.py
+import os
+import shutil
+import pytest
+import config
+import storage_manager
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    """Runs storage_manager against a local bucket, with profiles/ under tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, "STORAGE_BACKEND", "local")
+    monkeypatch.setattr(config, "STORAGE_LOCAL_DIR", str(tmp_path / "bucket"))
+    monkeypatch.setattr(config, "PROFILE_SYNC_STRATEGY", "manifest")
+    monkeypatch.setattr(config, "PROFILE_CHUNK_SIZE", 4)
+    monkeypatch.setattr(config, "PROFILE_CACHE_MAX_MB", 0)
+    monkeypatch.setattr(config, "PROFILE_CHUNK_GC_INTERVAL_SECONDS", float("inf"))
+    monkeypatch.setattr(storage_manager, "_backend", None)
+    return tmp_path / "bucket"
+
+
+def _write_profile(session_id, data):
+    path = os.path.join(storage_manager.PROFILES_DIR, session_id, "Default", "data.ldb")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _stored_chunks(bucket):
+    return {name for _, _, names in os.walk(bucket / "chunks") for name in names}
+
+
+def test_sweep_deletes_only_unreferenced_chunks(bucket):
+    _write_profile("alice", b"aaaabbbb")
+    _write_profile("bob", b"aaaacccc")
+    assert storage_manager.upload_session("alice") and storage_manager.upload_session("bob")
+    _write_profile("alice", b"ddddeeee")
+    assert storage_manager.upload_session("alice")
+    before = _stored_chunks(bucket)
+
+    # Within the grace period nothing goes, not even the chunk alice no longer uses
+    assert storage_manager.collect_garbage_chunks(grace_seconds=3600) == 0
+    assert _stored_chunks(bucket) == before
+
+    # "bbbb" was only in alice's old manifest; "aaaa" is still bob's
+    assert storage_manager.collect_garbage_chunks(grace_seconds=0) == 1
+    assert len(_stored_chunks(bucket)) == len(before) - 1
+
+    for session_id, expected in (("alice", b"ddddeeee"), ("bob", b"aaaacccc")):
+        shutil.rmtree(os.path.join(storage_manager.PROFILES_DIR, session_id))
+        shutil.rmtree(storage_manager.LOCAL_MANIFESTS_DIR, ignore_errors=True)
+        assert storage_manager.download_session(session_id)
+        with open(os.path.join(storage_manager.PROFILES_DIR, session_id, "Default", "data.ldb"), "rb") as f:
+            assert f.read() == expected
+
+
+def test_unreachable_manifest_is_not_treated_as_missing(bucket, monkeypatch):
+    _write_profile("alice", b"aaaabbbb")
+    assert storage_manager.upload_session("alice")
+    before = _stored_chunks(bucket)
+
+    def unreachable(path):
+        raise ConnectionError("timed out")
+    monkeypatch.setattr(storage_manager.backend(), "download", unreachable)
+    shutil.rmtree(storage_manager.LOCAL_MANIFESTS_DIR)
+    _write_profile("alice", b"aaaacccc")
+
+    # No rebuild from scratch: the save fails and the local copy is kept for the sync
+    assert not storage_manager.upload_session("alice")
+    assert _stored_chunks(bucket) == before
+    assert storage_manager.download_session("alice")
@@ -426,129 +426,332 @@
 #!/usr/bin/env python3
 import utility
 # utility.install_missing_libs() # Uncomment on first local run only
+import os
+import re
 import time
 import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import controller as db
 import selenium_handler as sh
 import config
 import bot_state # The global state/lock
 import storage_manager
 import ai_manager
+import database_manager
+import browser_pool
+import download_manager
+from profile_transfers import transfers
+from session_scheduler import SessionScheduler
 from api_routes import app
 
+# Chat-list rows that are never opened by the sync
+CHAT_LIST_BLACKLIST = {"WhatsApp"}
+# Previews WhatsApp shows only while someone is active in the chat
+TRANSIENT_PREVIEW = re.compile(r"(typing|recording audio|recording video|recording)(…|\.\.\.)$", re.IGNORECASE)
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
 def process_single_user(session_id):
     """
-    Downloads profile -> Opens Chrome -> Syncs -> Replies -> Closes Chrome.
+    Downloads profile (unless prefetched) -> Leases a (warm) browser -> Syncs -> Replies
+    -> Returns the browser -> Queues the profile upload. Returns {"new_messages", "unread_backlog"} for the scheduler, or None if the sync failed.
     """
     print(f"\n--- 🔄 Starting Cycle for User: {session_id} ---")
     
-    # 1. Download Session
-    if not storage_manager.download_session(session_id):
+    # 1. Download Session (usually already done by the prefetcher)
+    if not (transfers.take_prefetched(session_id) or storage_manager.download_session(session_id)):
         print(f"   ⚠️ Skipping {session_id}: Could not download profile.")
-        return
+        return None
 
     driver = None
+    failed = False
+    stats = {"new_messages": 0, "unread_backlog": 0}
     try:
-        # 2. Open Chrome (Headless)
-        driver = sh.open_whatsapp(headless=True, session_id=session_id)
+        # 2. Lease Chrome (reused if it is still warm from the last cycle)
+        driver = browser_pool.pool.lease(session_id, mode="sync")
         if not driver:
             print(f"   ❌ Failed to open browser for {session_id}")
-            return
+            failed = True
+            return None
 
-        # 3. Check for Unread Messages & Sync
+        # 3. Diff the chat list against the last snapshot & sync only changed chats
         print(f"   📂 Syncing messages for {session_id}...")
-        
-        # (Simplified Sync Logic from your original code)
-        unread_btn = sh.get_element(driver, "unread_filter_button", timeout=5, suppress_error=True)
-        if unread_btn:
-            unread_btn.click()
-            time.sleep(2)
-            contacts = sh.get_all_contacts(driver)
-            for contact in contacts:
-                name, number = sh.open_chat(driver, contact, [])
-                if name:
-                    # Get last msg from DB to know where to stop
-                    last_msg = db.get_last_message_from_db(number, name, "Me") # "Me" is generic owner
-                    data = sh.smart_scroll_and_collect(driver, stop_at_last=last_msg)
-                    db.save_messages_to_db(name, number, data)
-                    sh.close_current_chat(driver)
-            # Reset filter
-            unread_btn.click()
-        else:
-            print("   ✔️ No unread filter found/needed.")
+        rows = sh.harvest_chat_list(driver)
+        previous = database_manager.get_chat_list_snapshot(session_id)
+        changed = diff_chat_list(previous, rows)
+
+        if not changed:
+            print("   ✔️ Chat list unchanged since last cycle. Nothing to sync.")
+
+        processed_in_batch = set()
+        failed_keys = set()
+        for row in changed:
+            name, number = sh.open_chat(driver, row["title"], processed_in_batch, session_id=session_id, chat_id=row.get("chat_id"))
+            if not name:
+                failed_keys.add(database_manager.chat_list_key(row))
+                continue
+            processed_in_batch.add(number if number else name)
+            # Get last msg from DB to know where to stop
+            last_msg = db.get_last_message_from_db(number, name, "Me") # "Me" is generic owner
+            data = sh.smart_scroll_and_collect(driver, stop_at_last=last_msg, max_incoming=row["unread"] or None, incremental=True)
+            if not db.save_messages_to_db(name, number, data):
+                failed_keys.add(database_manager.chat_list_key(row))
+                sh.close_current_chat(driver)
+                continue
+            stats["new_messages"] += len(data)
+            database_manager.save_attachment_refs(session_id, row["title"], data)
+            sh.close_current_chat(driver)
+            # Opening the chat marked it read in WhatsApp
+            row["unread"] = 0
+
+        # Only chats whose messages were stored advance; failed ones keep their old snapshot and are retried
+        database_manager.save_chat_list_snapshot(session_id, [r for r in rows if database_manager.chat_list_key(r) not in failed_keys])
+        stats["unread_backlog"] = sum(r.get("unread") or 0 for r in rows)
+
+        # Fetch attachments that were requested on demand since the last cycle
+        fetch_requested_attachments(driver, session_id)
 
         # 4. AI Auto-Reply Logic
-        # (This checks DB for unreplied, generates AI, and sends via Selenium directly)
-        # For 512MB RAM, we do reply INSIDE this loop, not a separate task
+        # (Replies were generated outside the browser by prepare_replies; this only sends them)
         process_replies_for_active_driver(driver, session_id)
 
     except Exception as e:
+        failed = True
         print(f"   ❌ Error during sync for {session_id}: {e}")
     finally:
-        # 5. CRITICAL: Close Driver to free RAM
+        # 5. Let the session's attachment downloads finish, then return the browser;
+        #    the pool closes it if it failed or RAM is short
         if driver:
-            driver.quit()
-            print(f"   🔒 Closed browser for {session_id}")
+            database_manager.record_failed_downloads(session_id, download_manager.drain_download_queue(driver))
+            browser_pool.pool.give_back(session_id, driver, discard=failed)
         
-        # 6. Upload session to save new cookies/chats
-        storage_manager.upload_session(session_id)
+        # 6. Upload session to save new cookies/chats (in the background, once
+        #    no browser has the profile open; a warm one uploads when it closes)
+        transfers.upload(session_id)
 
-def process_replies_for_active_driver(driver, session_id):
-    """Checks DB for pending replies and sends them while browser is open."""
-    unreplied = db.get_all_unreplied_conversations() # You might need to filter by session_id in future
-    
-    for conv in unreplied:
-        title = conv.get('title')
-        # Skip blacklisted
-        if title in ["Me", "WhatsApp", "My Notes"]: continue
-        
-        number = conv.get('phone_number')
-        print(f"   🤖 Generating AI reply for {title}...")
-        
-        history = db.get_prompt_history(number)
-        reply = ai_manager.generate_reply(history, "Me")
-        
-        if reply:
-            # Re-open chat and send
-            sh.open_chat(driver, title, [])
-            sh.send_reply(driver, reply)
-            # Save the sent message to DB immediately
-            db.save_messages_to_db(title, number, [{
-                "role": "me", "content": reply, 
-                "sender": "Me", "date": "Now", "time": "Now", 
-                "meta_text": f"AI Reply: {reply}"
-            }])
-            print(f"   ✅ Sent: {reply[:30]}...")
-            time.sleep(2)
+    return None if failed else stats
 
-def run_round_robin_loop():
-    """Infinite loop that cycles through all users."""
-    while True:
-        # 1. Check if a Login is happening via Frontend
-        if bot_state.state["status"] == "LOGIN_MODE":
-            print("⏳ Login in progress. Pausing sync loop for 30s...")
-            time.sleep(30)
+def _chat_list_time(timestamp, seen_at):
+    """
+    Resolves a chat-list timestamp ("10:42", "Yesterday", "Monday", "19/10/2026") to
+    (date, time of day or None) as of when it was seen, so a day rollover of the same
+    message compares equal. Unknown formats come back as-is.
+    """
+    text = (timestamp or "").strip()
+    day = seen_at.date()
+    if re.fullmatch(r"\d{1,2}:\d{2}(\s?[AP]M)?", text, re.IGNORECASE):
+        return day, text.upper()
+    if text.lower() == "yesterday":
+        return day - timedelta(days=1), None
+    if text.lower() in WEEKDAYS:
+        back = (day.weekday() - WEEKDAYS.index(text.lower())) % 7 or 7
+        return day - timedelta(days=back), None
+    try:
+        return datetime.strptime(text, "%d/%m/%Y").date(), None
+    except ValueError:
+        return text, None
+
+def _same_chat_time(old, new, old_seen_at, now):
+    old_day, old_time = _chat_list_time(old, old_seen_at)
+    new_day, new_time = _chat_list_time(new, now)
+    if old_day != new_day:
+        return False
+    return old_time is None or new_time is None or old_time == new_time
+
+def diff_chat_list(previous, rows):
+    """
+    Returns the chat-list rows whose preview or timestamp changed, or whose unread
+    count grew, since the stored snapshot. Without a snapshot only unread chats count.
+    A timestamp that only rolled over ("10:42" becoming "Yesterday") is not a change,
+    and a "typing…"/"recording…" preview keeps the stored preview in its place.
+    """
+    changed = []
+    now = datetime.now()
+    for row in rows:
+        title = row.get("title")
+        if not title or title in CHAT_LIST_BLACKLIST: continue
+        old = previous.get(database_manager.chat_list_key(row))
+        if old is None and row.get("chat_id"):
+            # Stored before chat ids were read: fall back to the title-keyed row
+            old = previous.get(title)
+            old = old if old and not old.get("chat_id") else None
+        if old is None:
+            if previous or row.get("unread"):
+                changed.append(row)
             continue
+        if TRANSIENT_PREVIEW.search(row.get("preview") or ""):
+            row["preview"] = old["preview"]
+        seen_at = datetime.fromisoformat(old["updated"]) if old.get("updated") else now
+        if row.get("preview") != old["preview"] \
+                or not _same_chat_time(old["timestamp"], row.get("timestamp"), seen_at, now) \
+                or row.get("unread", 0) > (old["unread"] or 0):
+            changed.append(row)
+    return changed
+
+def fetch_requested_attachments(driver, session_id):
+    """Downloads attachments requested through /api/attachments/<id>/fetch while the browser is open."""
+    for ref in database_manager.get_requested_attachments(session_id, config.ATTACHMENT_FETCH_BATCH_SIZE):
+        print(f"   📎 Fetching requested attachment '{ref['target_name']}'...")
+        filename = sh.fetch_deferred_attachment(driver, ref, session_id=session_id)
+        if filename:
+            database_manager.mark_attachment_fetched(ref["id"], filename)
+        else:
+            database_manager.mark_attachment_failed(ref["id"])
 
-        # 2. Acquire Lock to ensure we are the only one using Chrome
-        with bot_state.BROWSER_LOCK:
-            # Get list of users from Supabase Storage
-            # (You need to implement list_buckets or just assume specific names for now)
-            # For this example, we assume we get a list from storage_manager
-            users = storage_manager.list_available_sessions() 
-            
-            if not users:
-                print("💤 No users configured. Waiting...")
-            
-            for user_zip in users:
-                session_id = user_zip.replace(".zip", "")
-                process_single_user(session_id)
-                # Small pause between users to let CPU cool down
-                time.sleep(5)
+def prepare_replies(session_id):
+    """
+    Reply-preparation stage, run without a browser right after a session's messages
+    are saved: generates AI replies for conversations awaiting one, in one concurrent
+    batch, and queues them in PendingReplies. Returns how many were queued.
+    """
+    # Skip blacklisted
+    conversations = {conv["conversation_id"]: conv for conv in database_manager.get_conversations_awaiting_reply(session_id)
+                     if conv.get('title') not in ["Me", "WhatsApp", "My Notes"]}
+    if not conversations:
+        return 0
+
+    print(f"   🤖 Generating AI replies for {len(conversations)} conversation(s) of {session_id}...")
+    histories = database_manager.get_prompt_histories(conversations, count=config.AI_HISTORY_MESSAGES)
+    replies = ai_manager.generate_replies(histories, "Me")
+    ready = [(cid, conversations[cid]["last_message_index"], reply) for cid, reply in replies.items() if reply]
+    database_manager.save_pending_replies(session_id, ready)
+    return len(ready)
+
+def process_replies_for_active_driver(driver, session_id):
+    """Sends the replies prepared for this session while its browser is open. UI work only."""
+    for pending in database_manager.get_pending_replies(session_id):
+        title = pending['title']
+        number = pending['phone_number']
+        reply = pending['reply']
+        if not pending['is_current']:
+            # New messages arrived after it was generated; the next preparation answers those
+            database_manager.mark_pending_reply(pending['id'], 'stale')
+            continue
+        # Re-open chat and send
+        name, _ = sh.open_chat(driver, title, [], session_id=session_id)
+        if not name:
+            # Stays pending; the next sync retries it
+            print(f"   ⚠️ Could not open '{title}'. Reply kept for the next cycle.")
+            continue
+        sh.send_reply(driver, reply)
+        database_manager.mark_pending_reply(pending['id'], 'sent')
+        # Save the sent message to DB immediately
+        db.save_messages_to_db(title, number, [{
+            "role": "me", "content": reply, 
+            "sender": "Me", "date": "Now", "time": "Now", 
+            "meta_text": f"AI Reply: {reply}"
+        }])
+        print(f"   ✅ Sent: {reply[:30]}...")
+        time.sleep(2)
+
+def sync_worker_count():
+    """
+    How many sessions to sync at once: config.SYNC_WORKERS if set, otherwise
+    bounded by CPU cores and by available RAM per Chrome instance.
+    """
+    if config.SYNC_WORKERS > 0:
+        return config.SYNC_WORKERS
+    cores = os.cpu_count() or 1
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        available_mb = int(meminfo["MemAvailable"].split()[0]) // 1024
+    except (OSError, KeyError, ValueError):
+        return 1
+    return max(1, min(cores, available_mb // config.SYNC_WORKER_RAM_MB))
+
+def sync_session(session_id):
+    """Syncs one session under its own lock; a session busy with a login or send is skipped."""
+    session_lock = bot_state.get_session_lock(session_id)
+    # A login holds the lock, and an upload queued for it waits on that lock: don't wait behind it
+    if session_lock.locked():
+        print(f"   ⏭️ {session_id} is busy (login or send in progress). Skipping this cycle.")
+        return None
+    # Let a prefetch or the previous cycle's upload finish first
+    if not transfers.wait(session_id, timeout=config.PROFILE_TRANSFER_WAIT_SECONDS):
+        print(f"   ⏭️ Profile transfer for {session_id} is still running. Skipping this cycle.")
+        return None
+    if not session_lock.acquire(blocking=False):
+        print(f"   ⏭️ {session_id} is busy (login or send in progress). Skipping this cycle.")
+        return None
+    try:
+        return process_single_user(session_id)
+    finally:
+        session_lock.release()
 
-        # Wait before next full cycle (Configurable)
-        print(f"💤 Cycle complete. Sleeping {config.SYNC_INTERVAL_SECONDS}s...")
-        time.sleep(config.SYNC_INTERVAL_SECONDS)
+def run_round_robin_loop():
+    """
+    Infinite loop that syncs each user whenever the scheduler says it is due,
+    up to sync_worker_count() of them at a time.
+    """
+    workers = sync_worker_count()
+    print(f"🧵 Syncing up to {workers} session(s) in parallel.")
+    scheduler = SessionScheduler(
+        config.SYNC_MIN_INTERVAL_SECONDS, config.SYNC_MAX_INTERVAL_SECONDS, config.SYNC_INTERVAL_SECONDS,
+        target_messages=config.SYNC_TARGET_MESSAGES, smoothing=config.SYNC_RATE_SMOOTHING
+    )
+    running = {}  # future -> session_id
+    preparing = {}  # reply-preparation future -> session_id
+    last_refresh = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync") as executor, \
+            ThreadPoolExecutor(max_workers=config.REPLY_PREPARE_WORKERS, thread_name_prefix="reply") as reply_executor:
+        while True:
+            # Pick up added/removed users from Supabase Storage now and then
+            if time.time() - last_refresh > config.SESSION_LIST_REFRESH_SECONDS:
+                users = storage_manager.list_available_sessions()
+                if not users:
+                    print("💤 No users configured. Waiting...")
+                scheduler.set_sessions(users)
+                last_refresh = time.time()
+
+            # Reschedule finished sessions from what their sync observed
+            for future in [f for f in running if f.done()]:
+                session_id = running.pop(future)
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    print(f"   ❌ Sync task for {session_id} crashed: {e}")
+                    stats = None
+                scheduler.record(session_id, stats)
+                # Generate replies to what was just saved, with no browser open
+                if stats is not None and session_id not in preparing.values():
+                    preparing[reply_executor.submit(prepare_replies, session_id)] = session_id
+
+            # Bring sessions with freshly prepared replies forward so they get sent
+            for future in [f for f in preparing if f.done()]:
+                session_id = preparing.pop(future)
+                try:
+                    if future.result():
+                        scheduler.wake(session_id)
+                except Exception as e:
+                    print(f"   ❌ Reply preparation for {session_id} crashed: {e}")
+
+            # Start the most overdue sessions while workers are free
+            while len(running) < workers:
+                session_id = scheduler.pop_due()
+                if not session_id: break
+                running[executor.submit(sync_session, session_id)] = session_id
+
+            # Close warm browsers that sat idle too long or hold unsaved profiles (their close uploads them)
+            browser_pool.pool.trim()
+
+            # Download the next sessions' profiles while these sync
+            transfers.prefetch(scheduler.upcoming(config.PREFETCH_SESSIONS, config.PREFETCH_HORIZON_SECONDS))
+
+            next_due = scheduler.seconds_until_next()
+            timeout = config.SESSION_LIST_REFRESH_SECONDS
+            if next_due > config.PREFETCH_HORIZON_SECONDS:
+                # Wake up when the next session enters the prefetch horizon
+                timeout = min(timeout, next_due - config.PREFETCH_HORIZON_SECONDS)
+            if len(running) < workers:
+                # Only a free worker can start the next due session; while all are
+                # busy an overdue session would otherwise make this loop spin
+                timeout = min(timeout, next_due)
+            if running or preparing:
+                wait([*running, *preparing], timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(max(timeout, 1))
 
 if __name__ == "__main__":
     # 1. Start Flask API (Frontend) in Background
@@ -559,10 +762,12 @@ if __name__ == "__main__":
     api_thread.start()
     
     # 2. Initialize DB
-    import database_manager
     database_manager.init_db()
     print("✅ Database Initialized.")
 
-    # 3. Start the Main Sync Loop
+    # 3. Resolve ChromeDriver once so browser launches skip the version check
+    sh.resolve_chromedriver_path()
+
+    # 4. Start the Main Sync Loop
     print("🤖 Starting Round-Robin Sync Loop...")
     run_round_robin_loop()
\ No newline at end of file